@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from telegram.ext import Updater, CommandHandler
 import logging
 import datetime
+import os
+import socket
 
-from data import SessionGen, create_db, User, Phase, Statement, Circle, Moment
+from data import SessionGen, Circle, Moment, change_feed
+from migrations import upgrade
 
 def main():
-    create_db()
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                         level=logging.DEBUG)
+    upgrade()
+    # Let the running bot processes know about the new moments
+    change_feed.enable('admin:{}:{}'.format(socket.gethostname(), os.getpid()))
     with SessionGen(True) as session:
         circle = Circle()
         circle.name = "Famiglia"
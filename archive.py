@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import datetime
+
+from data import SessionGen, Phase, Moment, User, Statement, PhaseTally, PhaseRollup, SentReminder
+from sqlalchemy import and_, or_
+
+def archive_batch(session, cutoff, batch_size):
+    """Fold the statements of up to batch_size phases older than cutoff
+    into the monthly rollups and delete them, together with the phases.
+    Return the number of archived phases.
+
+    Users that did not answer are counted among the members that the
+    circle has at archiving time, since membership history is not kept;
+    the ones with a default choice are counted as present or absent.
+
+    """
+    phase_ids = [phase_id for (phase_id,) in session.query(Phase.id).filter(Phase.date < cutoff). \
+                 order_by(Phase.id).limit(batch_size)]
+    if len(phase_ids) == 0:
+        return 0
+
+    counts = collections.defaultdict(lambda: [0, 0, 0])
+    statements = session.query(Statement.user_id, Moment.circle_id, Phase.date, Statement.choice). \
+        join(Phase, Statement.phase_id == Phase.id).join(Moment, Phase.moment_id == Moment.id). \
+        filter(Phase.id.in_(phase_ids)).filter(Statement.choice != None)
+    for user_id, circle_id, date, choice in statements:
+        counts[(user_id, circle_id, date.replace(day=1))][0 if choice > 0 else 1] += 1
+    # Members without a choice count with their default one, if any
+    no_answers = session.query(User.id, Moment.circle_id, Phase.date, User.default_choice). \
+        select_from(Phase).join(Moment, Phase.moment_id == Moment.id). \
+        join(User, User.circle_id == Moment.circle_id). \
+        outerjoin(Statement, and_(Statement.phase_id == Phase.id, Statement.user_id == User.id)). \
+        filter(Phase.id.in_(phase_ids)).filter(or_(Statement.id == None, Statement.choice == None))
+    for user_id, circle_id, date, default_choice in no_answers:
+        counts[(user_id, circle_id, date.replace(day=1))][{True: 0, False: 1, None: 2}[default_choice]] += 1
+
+    for (user_id, circle_id, month), (presents, absents, missing) in sorted(counts.items()):
+        PhaseRollup.add(session, user_id, circle_id, month, presents, absents, missing)
+    for model, column in [(Statement, Statement.phase_id), (PhaseTally, PhaseTally.phase_id),
+                          (SentReminder, SentReminder.phase_id), (Phase, Phase.id)]:
+        session.query(model).filter(column.in_(phase_ids)).delete(synchronize_session=False)
+    return len(phase_ids)
+
+def archive_phases(horizon_days, batch_size=500, today=None):
+    """Archive every phase older than horizon_days days, one batch per
+    transaction. Return the number of archived phases.
+
+    """
+    if today is None:
+        today = datetime.date.today()
+    # Yesterday's phases can still be current
+    cutoff = today - datetime.timedelta(days=max(horizon_days, 2))
+    total = 0
+    while True:
+        with SessionGen(True) as session:
+            count = archive_batch(session, cutoff, batch_size)
+        total += count
+        if count < batch_size:
+            return total
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the command handlers on synthetic circles.
+
+The bot runs against a scratch SQLite database in a temporary
+directory, with fake bot and update objects. For each command the
+p50/p99 latency, the number of SQL statements and the number of
+outbound messages are reported and saved as JSON, so that two runs can
+be compared with --compare.
+
+With --concurrency N, /status is also run from N threads while another
+thread keeps sending /present, and the throughput of /status is
+reported; the SQLite settings can be changed with --journal-mode,
+--synchronous and --busy-timeout to compare them.
+
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+class FakeBot(object):
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+class FakeObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def make_update(tid, text):
+    from_user = FakeObject(id=tid, first_name='User', last_name=str(tid), username=None)
+    return FakeObject(message=FakeObject(from_user=from_user, chat_id=tid, text=text))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def populate(data, circles, members, moments, loud):
+    rng = random.Random(0)
+    with data.SessionGen(True) as session:
+        for i in range(circles):
+            circle = data.Circle()
+            circle.name = 'circle{}'.format(i)
+            session.add(circle)
+            for j in range(moments):
+                moment = data.Moment()
+                moment.circle = circle
+                moment.name = 'moment{}'.format(j)
+                minutes = j * 24 * 60 // moments
+                moment.time = datetime.time(hour=minutes // 60, minute=minutes % 60)
+                moment.reminder_time = moment.time
+                session.add(moment)
+            session.flush()
+            session.execute(data.User.__table__.insert(), [
+                {'circle_id': circle.id, 'tid': i * members + k + 1,
+                 'first_name': 'User', 'last_name': str(i * members + k + 1),
+                 'username': None, 'enabled': True, 'reminder': True,
+                 'loud': rng.random() < loud, 'digest': False}
+                for k in range(members)])
+        data.pregenerate_phases(session, 1)
+
+@contextlib.contextmanager
+def scratch_dir(prefix):
+    """Create a temporary directory and remove it, with everything in
+    it, when the block exits.
+
+    """
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield workdir
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def prepare(workdir, database, config):
+    """Write the configuration files in workdir, move there and import
+    the bot; database defaults to a scratch SQLite file in workdir, and
+    can be ':memory:'. Return the data and cibot modules.
+
+    """
+    if database is not None and database != ':memory:':
+        database = os.path.abspath(database)
+    for name, value in config.items():
+        with open(os.path.join(workdir, name), 'w') as fout:
+            fout.write(str(value))
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    data = importlib.import_module('data')
+    cibot = importlib.import_module('cibot')
+    if database == ':memory:':
+        data.engines.configure('sqlite://')
+    else:
+        data.engines.configure('sqlite:///' + (database or os.path.join(workdir, 'bench.sqlite')))
+    return data, cibot
+
+def run(args, workdir):
+    data, cibot = prepare(workdir, args.database, {'sqlite_journal_mode': args.journal_mode,
+                                                   'sqlite_synchronous': args.synchronous,
+                                                   'sqlite_busy_timeout': args.busy_timeout,
+                                                   'db_pool_size': max(5, args.concurrency + 1)})
+    from sqlalchemy import event
+
+    statements = [0]
+    def count_statement(*args):
+        statements[0] += 1
+    event.listen(data.get_engine(), 'before_cursor_execute', count_statement)
+    if data.get_read_engine() is not data.get_engine():
+        event.listen(data.get_read_engine(), 'before_cursor_execute', count_statement)
+
+    data.create_db()
+    populate(data, args.circles, args.members, args.moments, args.loud)
+
+    with data.SessionGen(False) as session:
+        moment_ids = [moment_id for (moment_id,) in session.query(data.Moment.id)]
+    tids = list(range(1, args.circles * args.members + 1))
+    bot = FakeBot()
+    rng = random.Random(1)
+    commands = [
+        ('present', lambda: cibot.handle_present(bot, make_update(rng.choice(tids), '/present'))),
+        ('status', lambda: cibot.handle_status(bot, make_update(rng.choice(tids), '/status'))),
+        ('message', lambda: cibot.handle_message(bot, make_update(rng.choice(tids), 'late'))),
+        ('reminder_job', lambda: cibot.handle_reminder_job(bot, FakeObject(context=rng.choice(moment_ids)))),
+    ]
+
+    results = {}
+    for name, command in commands:
+        latencies = []
+        counts = []
+        messages = []
+        for i in range(args.iterations):
+            statements[0] = 0
+            bot.sent = 0
+            start = time.perf_counter()
+            command()
+            latencies.append(time.perf_counter() - start)
+            counts.append(statements[0])
+            messages.append(bot.sent)
+        # Write the buffered comments before the next command
+        cibot.comments.flush()
+        results[name] = {
+            'p50_ms': percentile(latencies, 0.5) * 1000.0,
+            'p99_ms': percentile(latencies, 0.99) * 1000.0,
+            'statements': sum(counts) / float(len(counts)),
+            'messages': sum(messages) / float(len(messages)),
+        }
+
+    if args.concurrency > 0:
+        results['status_concurrent'] = run_concurrent(data, cibot, bot, tids, statements, args)
+
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'parameters': {'circles': args.circles, 'members': args.members, 'moments': args.moments,
+                       'loud': args.loud, 'iterations': args.iterations, 'concurrency': args.concurrency,
+                       'journal_mode': args.journal_mode, 'synchronous': args.synchronous,
+                       'busy_timeout': args.busy_timeout},
+        'results': results,
+    }
+
+def run_concurrent(data, cibot, bot, tids, statements, args):
+    """Run /status from args.concurrency threads, args.iterations times
+    each, while a writer thread keeps sending /present. The rendered
+    status cache is disabled, so that every /status reads the database.
+
+    """
+    data.status_cache.max_size = 0
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def reader(seed):
+        rng = random.Random(seed)
+        for i in range(args.iterations):
+            start = time.perf_counter()
+            try:
+                cibot.handle_status(bot, make_update(rng.choice(tids), '/status'))
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    def writer():
+        rng = random.Random(0)
+        while not done.is_set():
+            try:
+                cibot.handle_present(bot, make_update(rng.choice(tids), '/present'))
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+    statements[0] = 0
+    bot.sent = 0
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    threads = [threading.Thread(target=reader, args=(i + 2,)) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    writer_thread.join()
+
+    total = args.concurrency * args.iterations
+    return {
+        'p50_ms': percentile(latencies, 0.5) * 1000.0 if latencies else 0.0,
+        'p99_ms': percentile(latencies, 0.99) * 1000.0 if latencies else 0.0,
+        'statements': statements[0] / float(total),
+        'messages': bot.sent / float(total),
+        'throughput': len(latencies) / elapsed,
+        'errors': errors[0],
+    }
+
+def print_report(report, previous=None):
+    print("{:<14} {:>10} {:>10} {:>11} {:>9}".format('command', 'p50 ms', 'p99 ms', 'statements', 'messages'))
+    for name, result in report['results'].items():
+        line = "{:<14} {:>10.2f} {:>10.2f} {:>11.1f} {:>9.1f}".format(
+            name, result['p50_ms'], result['p99_ms'], result['statements'], result['messages'])
+        if previous is not None and name in previous['results']:
+            old = previous['results'][name]
+            line += "   (p50 {:+.1f}%, statements {:+.1f})".format(
+                (result['p50_ms'] / old['p50_ms'] - 1.0) * 100.0, result['statements'] - old['statements'])
+        if 'throughput' in result:
+            line += "   {:.0f} req/s, {} errors".format(result['throughput'], result['errors'])
+            if previous is not None and 'throughput' in previous['results'].get(name, {}):
+                line += " (throughput {:+.1f}%)".format(
+                    (result['throughput'] / previous['results'][name]['throughput'] - 1.0) * 100.0)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the command handlers on synthetic circles")
+    parser.add_argument('--circles', type=int, default=10)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--moments', type=int, default=2)
+    parser.add_argument('--loud', type=float, default=0.5, help="fraction of loud members")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--database', help="SQLite file to use instead of a temporary one, or :memory:")
+    parser.add_argument('--concurrency', type=int, default=0, help="threads running /status concurrently")
+    parser.add_argument('--journal-mode', default='wal', help="SQLite journal_mode pragma")
+    parser.add_argument('--synchronous', default='normal', help="SQLite synchronous pragma")
+    parser.add_argument('--busy-timeout', type=int, default=5000, help="SQLite busy_timeout in milliseconds")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help="results of a previous run to compare with")
+    args = parser.parse_args()
+    if args.database == ':memory:' and args.concurrency > 0:
+        parser.error("an in-memory database has a single connection, it cannot be used with --concurrency")
+    args.output = os.path.abspath(args.output)
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as fin:
+            previous = json.load(fin)
+
+    with scratch_dir('cibot_bench_') as workdir:
+        report = run(args, workdir)
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=2)
+    print_report(report, previous)
+
+if __name__ == '__main__':
+    main()
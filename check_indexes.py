@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Check that the queries of Circle and User are backed by indexes.
+
+A throwaway circle, moment and user are created in a transaction that
+is rolled back at the end; the Circle and User methods are run on them
+and every query they send to the database is passed to EXPLAIN. The
+check fails if any plan reads a whole table. Run it after the
+migrations, against the configured database.
+
+"""
+
+from sqlalchemy import event
+import collections
+import datetime
+import re
+import sys
+
+from data import get_engine, SessionGen, Base, Circle, Moment, User, schedule_cache, identity_cache
+
+TelegramUser = collections.namedtuple('TelegramUser', ['id'])
+
+def exercise(session, circle, user, when):
+    circle.get_schedule_index()
+    statement = user.get_current_statement(when=when, for_update=True)
+    statement.set_choice(1)
+    session.flush()
+    circle.get_status(when=when)
+    circle.get_reminder_targets(when=when)
+    circle.get_tally(statement.phase)
+    User.get_from_telegram_user(session, TelegramUser(user.tid))
+    user.set_default_choice(False)
+    user.set_circle(None)
+    session.flush()
+
+def get_full_scans(cursor, dialect, statement, parameters):
+    tables = set(Base.metadata.tables.keys())
+    if dialect == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        details = [row[-1] for row in cursor.fetchall()]
+        pattern = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+    elif dialect == 'postgresql':
+        # Without this tiny tables are always read sequentially
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        details = [row[0] for row in cursor.fetchall()]
+        pattern = re.compile(r'Seq Scan on (\w+)')
+    else:
+        raise RuntimeError("EXPLAIN is not supported on {}".format(dialect))
+    scans = []
+    for detail in details:
+        match = pattern.search(detail.strip())
+        if match is not None and match.group(1) in tables:
+            scans.append(detail.strip())
+    return scans
+
+def main():
+    engine = get_engine()
+    queries = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        if not statement.lstrip().upper().startswith('INSERT') or 'SELECT' in statement.upper():
+            queries.append((statement, parameters))
+
+    failures = 0
+    with SessionGen() as session:
+        circle = Circle(name='check_indexes')
+        moment = Moment(circle=circle, name='check_indexes', time=datetime.time(12, 0), reminder_time=datetime.time(11, 0))
+        user = User(circle=circle, tid=-1, first_name='Check', last_name='Indexes', enabled=True, reminder=True)
+        session.add_all([circle, moment, user])
+        session.flush()
+        # Otherwise some of the queries would be answered by the caches
+        schedule_cache.clear()
+        identity_cache.clear()
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            exercise(session, circle, user, datetime.datetime.combine(datetime.date(2000, 1, 1), datetime.time(10, 0)))
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        cursor = session.connection().connection.cursor()
+        for statement, parameters in queries:
+            scans = get_full_scans(cursor, engine.dialect.name, statement, parameters)
+            if len(scans) > 0:
+                failures += 1
+                print("Full table scan in:\n{}\n  {}\n".format(statement.strip(), '\n  '.join(scans)))
+        cursor.close()
+
+    if failures == 0:
+        print("All {} queries use indexes".format(len(queries)))
+    return 1 if failures > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
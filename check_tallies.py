@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+
+from data import SessionGen, check_tallies
+
+def main():
+    fix = '--fix' in sys.argv[1:]
+    with SessionGen(fix) as session:
+        drifts = check_tallies(session, fix=fix)
+        for phase_id, stored, expected in drifts:
+            print("Phase {}: stored {}, expected {}".format(phase_id, stored, expected))
+    if len(drifts) == 0:
+        print("Tallies are consistent")
+    elif fix:
+        print("Fixed {} tallies".format(len(drifts)))
+    return 1 if len(drifts) > 0 and not fix else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,25 @@
 # -*- coding: utf-8 -*-
 
 from telegram import ReplyKeyboardMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 from telegram.ext.jobqueue import Job
 import logging
 import datetime
-
-from data import SessionGen, create_db, User, Phase, Statement, Circle, Moment
+import functools
+
+from data import get_engine, get_read_engine, can_cache, retry_on_conflict, identity_cache, SessionGen, User, Phase, Statement, Circle, Moment, pregenerate_phases, sync_schedule, status_cache, PhaseRollup, SentReminder
+from archive import archive_phases
+from config import get_config
+from outbound import outbox
+from digest import digest
+from comments import comments
+from reminders import scheduler
+from webhook import start_webhook
+from dispatch import install_keyed_dispatcher
+from leader import leader
+from migrations import upgrade
+from instrumentation import metrics, start_metrics_server
 
 def get_user(session, update):
     user = User.get_from_telegram_user(session, update.message.from_user)
@@ -28,6 +41,122 @@ def get_custom_keyboard():
                        ['/status']]
     return custom_keyboard
 
+class Effects(object):
+    """Outbound effects of a handler (replies and notifications), which
+    are collected during its transaction and run only once it has been
+    committed.
+
+    """
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.actions = []
+
+    def send(self, chat_id, text, reply_markup=None):
+        kwargs = {'chat_id': chat_id, 'text': text}
+        if reply_markup is not None:
+            kwargs['reply_markup'] = reply_markup
+        self.actions.append(lambda bot: outbox.send_message(bot, **kwargs))
+
+    def reply(self, text, reply_markup=None):
+        self.send(self.chat_id, text, reply_markup=reply_markup)
+
+    def notify(self, user, kind, text):
+        # Recipients are resolved now, while the session is still usable
+        for user2 in user.circle.members:
+            if user2.loud and user.id != user2.id:
+                if user2.digest:
+                    self.actions.append(lambda bot, tid=user2.tid, key=(user.id, kind): digest.add(bot, tid, key, text))
+                else:
+                    self.send(user2.tid, text)
+
+    def defer(self, func, *args):
+        self.actions.append(lambda bot: func(bot, *args))
+
+    def run(self, bot):
+        for action in self.actions:
+            action(bot)
+
+def transactional(func, read_only=False):
+    """Run a handler in its own transaction, passing it the session and
+    an Effects instance, and then run the effects if the transaction was
+    committed. Read-only handlers get a read-only session instead.
+    Transactions that conflict with concurrent ones are retried from
+    scratch.
+
+    """
+    @functools.wraps(func)
+    def wrapped(bot, update, *args, **kwargs):
+        def attempt():
+            effects = Effects(update.message.chat_id)
+            with SessionGen(not read_only, read_only=read_only) as session:
+                func(session, update, effects, *args, **kwargs)
+            return effects
+        retry_on_conflict(attempt).run(bot)
+    return wrapped
+
+def read_only(func):
+    return transactional(func, read_only=True)
+
+def split_message(parts, limit=MAX_MESSAGE_LENGTH):
+    """Join parts with blank lines into as few messages as possible,
+    none longer than limit. A part that does not fit in one message is
+    split between its lines, and a line that does not fit anywhere.
+
+    """
+    units = []
+    for part in parts:
+        separator = "\n\n"
+        for line in ([part] if len(part) <= limit else part.split("\n")):
+            while len(line) > limit:
+                units.append((separator, line[:limit]))
+                line = line[limit:]
+                separator = "\n"
+            units.append((separator, line))
+            separator = "\n"
+    messages = []
+    for separator, text in units:
+        if len(messages) > 0 and len(messages[-1]) + len(separator) + len(text) <= limit:
+            messages[-1] += separator + text
+        else:
+            messages.append(text)
+    return messages
+
+def render_status(circle, status, pending=None):
+    """Render the status of a circle as a list of messages; pending
+    maps user ids to the comments that have not been written yet, which
+    are shown instead of the stored ones.
+
+    """
+    if pending is None:
+        pending = {}
+
+    def render_list(desc, count, statements, users=None):
+        if users is None:
+            users = []
+        message = "{} ({})".format(desc, count)
+        if len(statements) + len(users) > 0:
+            message += ":"
+            if len(statements) > 0:
+                message += "\n"
+                message += "\n".join([st.get_pretty_name(pending.get(st.user.id)) for st in statements])
+            if len(users) > 0:
+                message += "\n"
+                message += "\n".join([u.get_pretty_name() + ((' (' + pending[u.id] + ')') if u.id in pending else '')
+                                       for u in users])
+        return message
+
+    # The counts come from the tally, the names from the status
+    tally = circle.get_tally(status.phase)
+    parts = [
+        "Known total is {}".format(tally.known_total),
+        render_list('Present', tally.presents, status.presents),
+        render_list('Absent', tally.absents, status.absents),
+        render_list('Unknown', tally.no_answers, status.unknowns, status.nonvoters),
+    ]
+    if circle.bottom_line is not None:
+        parts.append(circle.bottom_line)
+    return split_message(parts)
+
 def recognize_bool(value):
     value = value.lower()
     if value in ['false', '0', 'no']:
@@ -37,242 +166,340 @@ def recognize_bool(value):
     else:
         return None
 
-def handle_start(bot, update):
-    with SessionGen(True) as session:
-        db_user = get_user(session, update)
-        if db_user is None:
-            return
+@read_only
+def handle_start(session, update, effects):
+    db_user = get_user(session, update)
+    if db_user is None:
+        return
 
-        bot.send_message(chat_id=update.message.chat_id, text="Hello {}!".format(db_user.get_pretty_name()))
-        circle = db_user.circle
-        if circle is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You do not have a circle yet!")
-        else:
-            phase = circle.get_current_phase()
-            bot.send_message(chat_id=update.message.chat_id, text="Your circle is {}".format(circle.name))
-            bot.send_message(chat_id=update.message.chat_id, text="Now is {}".format(phase.get_pretty_name()))
-
-        reply_markup = ReplyKeyboardMarkup(get_custom_keyboard())
-        if circle.bottom_line is not None:
-            bot.send_message(chat_id=update.message.chat_id, reply_markup=reply_markup, text=circle.bottom_line)
-        else:
-            bot.sendMessage(chat_id=update.message.chat_id, reply_markup=reply_markup, text="Welcome!")
+    effects.reply("Hello {}!".format(db_user.get_pretty_name()))
+    circle = db_user.circle
+    if circle is None:
+        effects.reply("You do not have a circle yet!")
+    else:
+        phase = circle.get_current_phase()
+        effects.reply("Your circle is {}".format(circle.name))
+        effects.reply("Now is {}".format(phase.get_pretty_name()))
 
-def handle_join(bot, update, args):
-    with SessionGen(True) as session:
-        user = get_user(session, update)
-        if user is None:
-            return
+    reply_markup = ReplyKeyboardMarkup(get_custom_keyboard())
+    if circle is not None and circle.bottom_line is not None:
+        effects.reply(circle.bottom_line, reply_markup=reply_markup)
+    else:
+        effects.reply("Welcome!", reply_markup=reply_markup)
 
-        if len(args) < 1:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to specify a circle")
+@transactional
+def handle_join(session, update, effects, args):
+    user = get_user(session, update)
+    if user is None:
+        return
+
+    if len(args) < 1:
+        effects.reply("You have to specify a circle")
+        return
+    circle_name = args[0]
+
+    circle = session.query(Circle).filter(Circle.name == circle_name).first()
+    if circle is None:
+        effects.reply("Circle {} does not exist!".format(circle_name))
+        return
+
+    # Verify authorization
+    if not circle.can_join:
+        effects.reply("Circle {} cannot be joined".format(circle_name))
+        return
+    if circle.join_code is not None:
+        if len(args) < 2:
+            effects.reply("You have to specify a code to join circle {}".format(circle_name))
             return
-        circle_name = args[0]
-
-        circle = session.query(Circle).filter(Circle.name == circle_name).first()
-        if circle is None:
-            bot.send_message(chat_id=update.message.chat_id, text="Circle {} does not exist!".format(circle_name))
+        code = args[1]
+        if code != circle.join_code:
+            effects.reply("The code is invalid".format(circle_name))
             return
 
-        # Verify authorization
-        if not circle.can_join:
-            bot.send_message(chat_id=update.message.chat_id, text="Circle {} cannot be joined".format(circle_name))
-            return
-        if circle.join_code is not None:
-            if len(args) < 2:
-                bot.send_message(chat_id=update.message.chat_id, text="You have to specify a code to join circle {}".format(circle_name))
-                return
-            code = args[1]
-            if code != circle.join_code:
-                bot.send_message(chat_id=update.message.chat_id, text="The code is invalid".format(circle_name))
-                return
-
-        # Verify positively authorization as a precaution
-        if circle.can_join and (circle.join_code is None or circle.join_code == code):
-            user.circle = circle
-            bot.send_message(chat_id=update.message.chat_id, text="You just joined circle {}".format(circle.name))
-
-def handle_leave(bot, update):
-    with SessionGen(True) as session:
-        user = get_user(session, update)
-        if user is None:
-            return
+    # Verify positively authorization as a precaution
+    if circle.can_join and (circle.join_code is None or circle.join_code == code):
+        user.set_circle(circle)
+        effects.reply("You just joined circle {}".format(circle.name))
 
-        circle = user.circle
-        user.circle = None
-        if circle is not None:
-            bot.send_message(chat_id=update.message.chat_id, text="You just left circle {}".format(circle.name))
-        else:
-            bot.send_message(chat_id=update.message.chat_id, text="You were not a member of a circle")
+@transactional
+def handle_leave(session, update, effects):
+    user = get_user(session, update)
+    if user is None:
+        return
 
-def handle_present(bot, update):
-    with SessionGen(True) as session:
-        user, statement = get_user_and_statement(session, update, for_update=True)
-        if user is None:
-            return
+    circle = user.circle
+    user.set_circle(None)
+    if circle is not None:
+        effects.reply("You just left circle {}".format(circle.name))
+    else:
+        effects.reply("You were not a member of a circle")
 
-        if statement is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to join a circle before expressing your presence!")
-            return
+@transactional
+def handle_present(session, update, effects):
+    user, statement = get_user_and_statement(session, update, for_update=True)
+    if user is None:
+        return
 
-        statement.choice = 1
-        bot.send_message(chat_id=update.message.chat_id, text="We'll be happy to see you!")
+    if statement is None:
+        effects.reply("You have to join a circle before expressing your presence!")
+        return
 
-        for user2 in user.circle.members:
-            if user2.loud and user.id != user2.id:
-                bot.send_message(chat_id=user2.tid, text="{} just reported to be present".format(user.get_pretty_name()))
+    statement.set_choice(1)
+    effects.reply("We'll be happy to see you!")
 
-def handle_absent(bot, update):
-    with SessionGen(True) as session:
-        user, statement = get_user_and_statement(session, update, for_update=True)
-        if user is None:
-            return
+    effects.notify(user, 'choice', "{} just reported to be present".format(user.get_pretty_name()))
 
-        if statement is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to join a circle before expressing your presence!")
-            return
+@transactional
+def handle_absent(session, update, effects):
+    user, statement = get_user_and_statement(session, update, for_update=True)
+    if user is None:
+        return
 
-        statement.choice = 0
-        bot.send_message(chat_id=update.message.chat_id, text="So sorry you won't be dining with us!")
+    if statement is None:
+        effects.reply("You have to join a circle before expressing your presence!")
+        return
 
-        for user2 in user.circle.members:
-            if user2.loud and user.id != user2.id:
-                bot.send_message(chat_id=user2.tid, text="{} just reported to be absent".format(user.get_pretty_name()))
+    statement.set_choice(0)
+    effects.reply("So sorry you won't be dining with us!")
 
-def handle_next_present(bot, update):
-    with SessionGen(True) as session:
-        user, statement = get_user_and_statement(session, update, for_update=True, successive=True)
-        if user is None:
-            return
+    effects.notify(user, 'choice', "{} just reported to be absent".format(user.get_pretty_name()))
 
-        if statement is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to join a circle before expressing your presence!")
-            return
+@transactional
+def handle_next_present(session, update, effects):
+    user, statement = get_user_and_statement(session, update, for_update=True, successive=True)
+    if user is None:
+        return
 
-        statement.choice = 1
-        bot.send_message(chat_id=update.message.chat_id, text="We'll be happy to see you!")
+    if statement is None:
+        effects.reply("You have to join a circle before expressing your presence!")
+        return
 
-        for user2 in user.circle.members:
-            if user2.loud and user.id != user2.id:
-                bot.send_message(chat_id=user2.tid, text="{} just reported they will be present next time".format(user.get_pretty_name()))
+    statement.set_choice(1)
+    effects.reply("We'll be happy to see you!")
 
-def handle_next_absent(bot, update):
-    with SessionGen(True) as session:
-        user, statement = get_user_and_statement(session, update, for_update=True, successive=True)
-        if user is None:
-            return
+    effects.notify(user, 'next_choice', "{} just reported they will be present next time".format(user.get_pretty_name()))
 
-        if statement is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to join a circle before expressing your presence!")
-            return
+@transactional
+def handle_next_absent(session, update, effects):
+    user, statement = get_user_and_statement(session, update, for_update=True, successive=True)
+    if user is None:
+        return
 
-        statement.choice = 0
-        bot.send_message(chat_id=update.message.chat_id, text="So sorry you won't be dining with us!")
+    if statement is None:
+        effects.reply("You have to join a circle before expressing your presence!")
+        return
 
-        for user2 in user.circle.members:
-            if user2.loud and user.id != user2.id:
-                bot.send_message(chat_id=user2.tid, text="{} just reported they will be absent next time".format(user.get_pretty_name()))
+    statement.set_choice(0)
+    effects.reply("So sorry you won't be dining with us!")
 
-def handle_status(bot, update):
-    with SessionGen(True) as session:
-        user = get_user(session, update)
-        if user is None:
-            return
+    effects.notify(user, 'next_choice', "{} just reported they will be absent next time".format(user.get_pretty_name()))
 
+@read_only
+def handle_status(session, update, effects):
+    user = get_user(session, update)
+    if user is None:
+        return
+
+    circle_id = user.circle_id
+    if circle_id is None:
+        effects.reply("You have to join a circle before knowing about others' presence!")
+        return
+
+    # The rendered status is cached per phase and invalidated by
+    # version, so that usually no query is needed
+    index = Circle.get_schedule_index_by_id(session, circle_id)
+    key = (circle_id,) + index.resolve(datetime.datetime.now())
+    version = status_cache.get_version(circle_id)
+    cached = status_cache.get(key, version)
+    if cached is None:
         circle = user.circle
-        if circle is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to join a circle before knowing about others' presence!")
-            return
+        # Read through the comment buffer; adding a comment bumps the
+        # version, so the cached status cannot miss it
+        pending = dict([(user_id, text) for user_id, (text, when) in comments.get_pending(circle_id).items()
+                        if (circle_id,) + index.resolve(when) == key])
+        cached = (render_status(circle, circle.get_status(), pending), circle.bottom_line is not None)
+        if can_cache(session):
+            status_cache.set(key, version, cached)
+
+    messages, with_keyboard = cached
+    for text in messages[:-1]:
+        effects.reply(text)
+    if with_keyboard:
+        effects.reply(messages[-1], reply_markup=ReplyKeyboardMarkup(get_custom_keyboard()))
+    else:
+        effects.reply(messages[-1])
 
-        statements = circle.get_current_statements()
-        presents = [st for st in statements if st.choice is not None and st.choice > 0]
-        absents = [st for st in statements if st.choice is not None and st.choice == 0]
-        unknowns = [st for st in statements if st.choice is None]
-
-        nonvoters = circle.get_current_nonvoters()
-
-        def send_list(desc, statements, users=None):
-            if users is None:
-                users = []
-            message = "{} ({})".format(desc, len(statements) + len(users))
-            if len(statements) + len(users) > 0:
-                message += ":"
-                if len(statements) > 0:
-                    message += "\n"
-                    message += "\n".join([st.get_pretty_name() for st in statements])
-                if len(users) > 0:
-                    message += "\n"
-                    message += "\n".join([u.get_pretty_name() for u in users])
-            bot.send_message(chat_id=update.message.chat_id, text=message)
-
-        bot.send_message(chat_id=update.message.chat_id, text="Known total is {}".format(sum([st.choice for st in presents])))
-        send_list('Present', presents)
-        send_list('Absent', absents)
-        send_list('Unknown', unknowns, nonvoters)
-        if circle.bottom_line is not None:
-            reply_markup = ReplyKeyboardMarkup(get_custom_keyboard())
-            bot.send_message(chat_id=update.message.chat_id, reply_markup=reply_markup, text=circle.bottom_line)
-
-def handle_set(bot, update, args):
-    with SessionGen(True) as session:
-        user = get_user(session, update)
-        if user is None:
+@transactional
+def handle_set(session, update, effects, args):
+    user = get_user(session, update)
+    if user is None:
+        return
+
+    if len(args) != 2:
+        effects.reply("Please tell me what to set and its new value!")
+        return
+
+    [key, value] = args
+    if key == 'loud':
+        if value.lower() == 'digest':
+            user.loud = True
+            user.digest = True
+            effects.reply("Good, your setting was stored!")
             return
-
-        if len(args) != 2:
-            bot.send_message(chat_id=update.message.chat_id, text="Please tell me what to set and its new value!")
-
-        [key, value] = args
-        if key == 'loud':
-            value = recognize_bool(value)
-            if value is None:
-                bot.send_message(chat_id=update.message.chat_id, text="The value you selected could not be parsed")
-            else:
-                user.loud = value
-                bot.send_message(chat_id=update.message.chat_id, text="Good, your setting was stored!")
-        elif key == 'reminder':
-            value = recognize_bool(value)
-            if value is None:
-                bot.send_message(chat_id=update.message.chat_id, text="The value you selected could not be parsed")
-            else:
-                user.reminder = value
-                bot.send_message(chat_id=update.message.chat_id, text="Good, your setting was stored!")
+        value = recognize_bool(value)
+        if value is None:
+            effects.reply("The value you selected could not be parsed")
         else:
-            bot.send_message(chat_id=update.message.chat_id, text="The key you selected could not be parsed")
-
-def handle_message(bot, update):
-    with SessionGen(True) as session:
-        user, statement = get_user_and_statement(session, update, for_update=True)
-        if user is None:
+            user.loud = value
+            user.digest = False
+            effects.reply("Good, your setting was stored!")
+    elif key == 'reminder':
+        value = recognize_bool(value)
+        if value is None:
+            effects.reply("The value you selected could not be parsed")
+        else:
+            user.reminder = value
+            effects.reply("Good, your setting was stored!")
+    elif key == 'default':
+        if value.lower() == 'none':
+            user.set_default_choice(None)
+            effects.reply("Good, your setting was stored!")
             return
+        value = recognize_bool(value)
+        if value is None:
+            effects.reply("The value you selected could not be parsed")
+        else:
+            user.set_default_choice(value)
+            effects.reply("Good, your setting was stored!")
+    else:
+        effects.reply("The key you selected could not be parsed")
 
-        if statement is None:
-            bot.send_message(chat_id=update.message.chat_id, text="You have to join a circle before expressing your presence!")
+@read_only
+def handle_message(session, update, effects):
+    user = get_user(session, update)
+    if user is None:
+        return
+
+    if user.circle_id is None:
+        effects.reply("You have to join a circle before expressing your presence!")
+        return
+
+    # The comment is written later by write_comments()
+    effects.defer(comments.add, user.id, user.circle_id, update.message.text, datetime.datetime.now())
+    effects.reply("Thanks for your precious message!")
+
+def write_comments(bot, entries):
+    """Store the buffered comments in a single transaction and notify
+    each of them once.
+
+    """
+    def attempt():
+        effects = Effects(None)
+        with SessionGen(True) as session:
+            users = dict([(user.id, user) for user in
+                          session.query(User).filter(User.id.in_([user_id for user_id, _, _ in entries]))])
+            for user_id, text, when in entries:
+                user = users.get(user_id)
+                if user is None or not user.enabled:
+                    continue
+                statement = user.get_current_statement(when=when, for_update=True)
+                if statement is None:
+                    continue
+                statement.comment = text
+                effects.notify(user, 'comment', "{} just set their new message: \"{}\"".format(user.get_pretty_name(), text))
+        return effects
+    retry_on_conflict(attempt).run(bot)
+
+comments.writer = write_comments
+
+def send_reminders(bot, moment_id):
+    now = datetime.datetime.now()
+    with SessionGen(False) as session:
+        moment = session.query(Moment).filter(Moment.id == moment_id).one_or_none()
+        if moment is None or moment.circle is None:
             return
-
-        statement.comment = update.message.text
-        bot.send_message(chat_id=update.message.chat_id, text="Thanks for your precious message!")
-
-        for user2 in user.circle.members:
-            if user2.loud and user.id != user2.id:
-                bot.send_message(chat_id=user2.tid, text="{} just set their new message: \"{}\"".format(user.get_pretty_name(), update.message.text))
+        circle = moment.circle
+        tids = []
+        # The tally tells for free whether anyone is missing
+        if circle.get_tally(circle.get_current_phase(when=now)).no_answers > 0:
+            tids = [user.tid for user in circle.get_reminder_targets(when=now)]
+    # With more processes, a leader that lost its lease may still be
+    # sending: the claim makes each reminder go out once
+    if leader.holder is not None and not SentReminder.claim(moment_id, now):
+        return
+    for tid in tids:
+        outbox.send_message(bot, chat_id=tid, text="We would REALLY like to know if you'll be eating with us or not!")
 
 def handle_reminder_job(bot, job):
+    send_reminders(bot, job.context)
+
+def handle_schedule_poll(bot, job):
     with SessionGen(False) as session:
-        moment = session.query(Moment).filter(Moment.id == job.context).one()
-        circle = moment.circle
-        for user in circle.members:
-            if user.reminder and user.get_current_statement() is None:
-                bot.send_message(chat_id=user.tid, text="We would REALLY like to know if you'll be eating with us or not!")
+        sync_schedule(session)
 
-def main():
-    create_db()
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        level=logging.DEBUG)
-    token = open('telegram_token').read().strip()
-    updater = Updater(token=token)
+def handle_reminder_tick(bot, job):
+    scheduler = job.context
+    now = datetime.datetime.now()
+    with SessionGen(False) as session:
+        scheduler.refresh(session, now)
+    due = scheduler.pop_due(now)
+    if not leader.is_leader():
+        scheduler.defer(due, now)
+        return
+    # A new leader also sends what fell due while the lease of the old
+    # one was expiring; the ones the old leader sent are already claimed
+    since = now - datetime.timedelta(seconds=2 * leader.duration)
+    for moment_id in set(due) | set(scheduler.pop_deferred(since)):
+        send_reminders(bot, moment_id)
+
+@read_only
+def handle_history(session, update, effects):
+    user = get_user(session, update)
+    if user is None:
+        return
+
+    rollups = session.query(PhaseRollup).filter(PhaseRollup.user_id == user.id). \
+        order_by(PhaseRollup.month.desc()).limit(12).all()
+    if len(rollups) == 0:
+        effects.reply("There is no archived history yet!")
+        return
+    lines = ["{} ({}): present {}, absent {}, no answer {}".format(
+        rollup.month.strftime('%m/%Y'), rollup.circle.name, rollup.presents, rollup.absents, rollup.no_answers)
+             for rollup in rollups]
+    effects.reply("Your archived history:\n" + "\n".join(lines))
+
+def handle_archive_job(bot, job):
+    horizon_days, batch_size = job.context
+    count = archive_phases(horizon_days, batch_size)
+    logging.getLogger(__name__).info("Archived %d phases", count)
+
+def handle_pregenerate_job(bot, job):
+    def attempt():
+        with SessionGen(True) as session:
+            return pregenerate_phases(session, job.context)
+    count = retry_on_conflict(attempt)
+    logging.getLogger(__name__).info("Pregenerated %d phases", count)
+
+def get_dispatch_key(update):
+    """Return the key of the circle of the sender of update, so that
+    updates concerning the same circle are processed one at a time.
+
+    """
+    message = update.message
+    if message is None or message.from_user is None:
+        return None
+    tid = message.from_user.id
+    values = identity_cache.get(tid)
+    if values is not None:
+        circle_id = values['circle_id']
+    else:
+        with SessionGen(False, read_only=True) as session:
+            circle_id = session.query(User.circle_id).filter(User.tid == tid).scalar()
+    if circle_id is None:
+        return ('user', tid)
+    return ('circle', circle_id)
 
-    # Install handlers
+def install_handlers(dispatcher):
     handlers = [
         ('start', handle_start, {}),
         ('join', handle_join, {"pass_args": True}),
@@ -283,28 +510,92 @@ def main():
         ('next_absent', handle_next_absent, {}),
         ('status', handle_status, {}),
         ('set', handle_set, {"pass_args": True}),
+        ('history', handle_history, {}),
     ]
     for handler_data in handlers:
-        handler = CommandHandler(handler_data[0], handler_data[1], **handler_data[2])
-        updater.dispatcher.add_handler(handler)
-    message_handler = MessageHandler(Filters.text, handle_message)
-    updater.dispatcher.add_handler(message_handler)
+        handler = CommandHandler(handler_data[0], metrics.instrument(handler_data[0], handler_data[1]), **handler_data[2])
+        dispatcher.add_handler(handler)
+    message_handler = MessageHandler(Filters.text, metrics.instrument('message', handle_message))
+    dispatcher.add_handler(message_handler)
+
+def leader_only(func):
+    """Run a job only in the process holding the leader lease."""
+    @functools.wraps(func)
+    def wrapped(bot, job):
+        if leader.is_leader():
+            func(bot, job)
+    return wrapped
+
+def install_jobs(job_queue):
+    # The heavy jobs start a little later, so that they do not compete
+    # with the updates queued while the bot was down; in the meantime
+    # the handlers create the phases they need
+    start_delay = get_config('job_start_delay', 10.0, float)
+    pregenerate_days = get_config('pregenerate_days', 7, int)
+    job = Job(leader_only(metrics.instrument('pregenerate_job', handle_pregenerate_job)), interval=datetime.timedelta(hours=6), repeat=True, context=pregenerate_days)
+    job_queue.put(job, next_t=start_delay)
+
+    archive_context = (get_config('archive_days', 90, int), get_config('archive_batch', 500, int))
+    job = Job(leader_only(metrics.instrument('archive_job', handle_archive_job)), interval=datetime.timedelta(days=1), repeat=True, context=archive_context)
+    job_queue.put(job, next_t=3600)
+
+    # Every process polls the moments, since each has its own caches
+    job = Job(handle_schedule_poll, interval=get_config('schedule_poll_interval', 60.0, float), repeat=True)
+    job_queue.put(job, next_t=0)
+
+    # Every process follows the reminders, the leader sends them
+    job = Job(metrics.instrument('reminder_tick', handle_reminder_tick), interval=get_config('reminder_tick', 30.0, float), repeat=True, context=scheduler)
+    job_queue.put(job, next_t=0)
+
+def make_updater(token, metrics_port=None):
+    """Create the Updater with handlers and jobs, and start the
+    services it needs apart from receiving updates.
+
+    """
+    updater = Updater(token=token, base_url=get_config('bot_api_url'))
+    dispatch_workers = get_config('dispatch_workers', 0, int)
+    if dispatch_workers > 0:
+        install_keyed_dispatcher(updater, get_dispatch_key, workers=dispatch_workers)
+    install_handlers(updater.dispatcher)
+    install_jobs(updater.job_queue)
+
+    # Install instrumentation
+    metrics.slow_query_threshold = get_config('slow_query_ms', 100.0, float) / 1000.0
+    metrics.install(get_engine())
+    if get_read_engine() is not get_engine():
+        metrics.install(get_read_engine())
+    if metrics_port is not None:
+        start_metrics_server(port=metrics_port)
+
+    digest.window = get_config('digest_window', 300.0, float)
+    comments.window = get_config('comment_window', 2.0, float)
+    comments.max_delay = get_config('comment_max_delay', 10.0, float)
+    outbox.start(updater.bot, workers=get_config('outbound_workers', 4, int))
+    return updater
+
+def flush_pending(updater):
+    comments.flush()
+    digest.flush_all(updater.bot)
+    outbox.stop()
 
-    # Install jobs
-    # TODO: update jobs when database is modified
-    with SessionGen(False) as session:
-        for circle in session.query(Circle):
-            for moment in circle.moments:
-                job = Job(handle_reminder_job, interval=datetime.timedelta(days=1), repeat=True, context=moment.id)
-                next_datetime = datetime.datetime.combine(datetime.date.today(), moment.reminder_time)
-                if datetime.datetime.now() > next_datetime:
-                    next_datetime += datetime.timedelta(days=1)
-                next_t = (next_datetime - datetime.datetime.now()).total_seconds()
-                updater.job_queue.put(job, next_t=next_t)
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.DEBUG)
+    upgrade()
+    token = open('telegram_token').read().strip()
+    updater = make_updater(token, metrics_port=get_config('metrics_port', None, int))
 
     # Start main cycle
-    updater.start_polling()
+    if get_config('update_mode', 'polling') == 'webhook':
+        start_webhook(updater,
+                      listen=get_config('webhook_listen', '127.0.0.1'),
+                      port=get_config('webhook_port', 8443, int),
+                      url_path=get_config('webhook_path', token),
+                      webhook_url=get_config('webhook_url'))
+    else:
+        updater.start_polling()
     updater.idle()
+    flush_pending(updater)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Run the bot as cluster_workers processes sharing the database.
+
+This process receives the updates (by polling or webhook, as cibot.py)
+and forwards each of them to a worker chosen by chat id, so that the
+updates of a chat are always handled by the same process, in order.
+Every worker runs the handlers and the jobs, but the jobs do something
+only in the worker holding the leader lease. Cache invalidations are
+exchanged through the cache_changes table.
+
+"""
+
+from telegram import Update
+from telegram.ext import Updater
+from telegram.ext.jobqueue import Job
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+
+from config import get_config
+from data import SessionGen, change_feed
+from dispatch import PartitionedDispatcher
+from leader import leader
+from migrations import upgrade
+from webhook import start_webhook
+import cibot
+
+logger = logging.getLogger(__name__)
+
+def handle_change_poll(bot, job):
+    with SessionGen(False) as session:
+        change_feed.poll(session)
+
+def handle_change_prune(bot, job):
+    with SessionGen(True) as session:
+        change_feed.prune(session, job.context)
+
+def run_worker(index, queue):
+    logging.basicConfig(format='%(asctime)s - worker {} - %(name)s - %(levelname)s - %(message)s'.format(index),
+                        level=get_config('log_level', 'INFO'))
+    holder = '{}:{}'.format(socket.gethostname(), os.getpid())
+    leader.enable(holder, get_config('leader_lease', 90.0, float))
+    change_feed.enable(holder)
+
+    token = open('telegram_token').read().strip()
+    metrics_port = get_config('metrics_port', None, int)
+    updater = cibot.make_updater(token, metrics_port=metrics_port + index if metrics_port is not None else None)
+    job_queue = updater.job_queue
+    job_queue.put(Job(handle_change_poll, interval=get_config('cache_poll_interval', 1.0, float), repeat=True), next_t=0)
+    job_queue.put(Job(cibot.leader_only(handle_change_prune), interval=3600.0, repeat=True,
+                      context=get_config('cache_change_retention', 3600.0, float)), next_t=60)
+    job_queue.start()
+    dispatcher = threading.Thread(target=updater.dispatcher.start, name='dispatcher')
+    dispatcher.start()
+
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        try:
+            update = Update.de_json(json.loads(message), updater.bot)
+        except Exception:
+            logger.exception("Cannot decode update")
+            continue
+        updater.update_queue.put(update)
+
+    job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher.join()
+    cibot.flush_pending(updater)
+
+def start_workers(count):
+    # Workers are spawned rather than forked, so that they do not share
+    # the database connections of this process
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for i in range(count)]
+    workers = [context.Process(target=run_worker, args=(i, queue), name='worker_{}'.format(i))
+               for i, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+    return queues, workers
+
+def stop_workers(queues, workers):
+    for queue in queues:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+
+def main():
+    logging.basicConfig(format='%(asctime)s - router - %(name)s - %(levelname)s - %(message)s',
+                        level=get_config('log_level', 'INFO'))
+    upgrade()
+    queues, workers = start_workers(get_config('cluster_workers', 2, int))
+
+    token = open('telegram_token').read().strip()
+    updater = Updater(token=token, base_url=get_config('bot_api_url'))
+    updater.dispatcher = PartitionedDispatcher(updater.bot, updater.update_queue, queues, job_queue=updater.job_queue)
+    if get_config('update_mode', 'polling') == 'webhook':
+        start_webhook(updater,
+                      listen=get_config('webhook_listen', '127.0.0.1'),
+                      port=get_config('webhook_port', 8443, int),
+                      url_path=get_config('webhook_path', token),
+                      webhook_url=get_config('webhook_url'))
+    else:
+        updater.start_polling()
+    updater.idle()
+    stop_workers(queues, workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""End to end check of cluster.py: several worker processes run against
+a scratch SQLite database and the fake Telegram API of fake_api.py.
+Some members answer through the webhook, then every reminder must be
+sent exactly once and only to the members that did not answer. A member
+also asks /status before and after another member, served by another
+worker, answers: the second status must show the answer, which needs
+the caches to be invalidated across processes.
+
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from benchmark import scratch_dir
+from fake_api import FakeBotAPI, make_update, post_update
+
+REMINDER_TEXT = "We would REALLY like to know if you'll be eating with us or not!"
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for_port(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1.0).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that a cluster sends each reminder once")
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--answering', type=int, default=5, help="members answering before the reminder")
+    parser.add_argument('--delay', type=float, default=15.0, help="seconds from now to the reminder")
+    args = parser.parse_args()
+    with scratch_dir('cibot_cluster_') as workdir:
+        return check(args, workdir)
+
+def check(args, workdir):
+    api = FakeBotAPI()
+    api.start()
+    port = get_free_port()
+    config = {'database_url': 'sqlite:///' + os.path.join(workdir, 'cluster.sqlite'),
+              'telegram_token': '123:fake',
+              'bot_api_url': api.url,
+              'update_mode': 'webhook',
+              'webhook_port': port,
+              'webhook_path': 'hook',
+              'cluster_workers': args.workers,
+              'reminder_tick': 0.5,
+              'leader_lease': 3.0,
+              'cache_poll_interval': 0.5}
+    for name, value in config.items():
+        with open(os.path.join(workdir, name), 'w') as fout:
+            fout.write(str(value))
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import data
+
+    # The reminder must fall on the same day and on a whole second
+    reminder = (datetime.datetime.now() + datetime.timedelta(seconds=args.delay)).replace(microsecond=0)
+    if reminder.date() != datetime.date.today():
+        print("Too close to midnight, try again later")
+        return 1
+    data.create_db()
+    with data.SessionGen(True) as session:
+        circle = data.Circle(name='Cluster')
+        session.add(circle)
+        session.add(data.Moment(circle=circle, name='dinner', time=datetime.time(23, 59),
+                                reminder_time=reminder.time()))
+        for tid in range(1, args.members + 1):
+            session.add(data.User(circle=circle, tid=tid, first_name='User', last_name=str(tid),
+                                  enabled=True, reminder=True))
+
+    cluster = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cluster.py')])
+    try:
+        if not wait_for_port(port, 30.0):
+            print("The cluster did not start")
+            return 1
+        url = 'http://127.0.0.1:{}/hook'.format(port)
+        for tid in range(1, args.answering + 1):
+            post_update(url, make_update(tid, tid, '/present'))
+        # The observer and the absent member are served by different
+        # workers
+        observer, absent = args.answering + 1, args.answering + 2
+        for update_id, tid, text in [(100, observer, '/status'), (101, absent, '/absent'), (102, observer, '/status')]:
+            time.sleep(2.0)
+            post_update(url, make_update(update_id, tid, text))
+        while datetime.datetime.now() < reminder + datetime.timedelta(seconds=5):
+            time.sleep(0.5)
+    finally:
+        cluster.terminate()
+        cluster.wait()
+        api.stop()
+
+    received = collections.Counter([chat_id for chat_id, text in api.sent if text == REMINDER_TEXT])
+    answers = collections.Counter([chat_id for chat_id, text in api.sent if text == "We'll be happy to see you!"])
+    statuses = [text for chat_id, text in api.sent if chat_id == observer and text.startswith("Known total")]
+    failures = 0
+    if len(statuses) != 2 or "Absent (0)" not in statuses[0] or "Absent (1)" not in statuses[1]:
+        failures += 1
+        print("Unexpected statuses: {!r}".format(statuses))
+    for tid in range(1, args.members + 1):
+        expected_reminders = 0 if tid <= args.answering or tid == absent else 1
+        expected_answers = 1 if tid <= args.answering else 0
+        if received[tid] != expected_reminders or answers[tid] != expected_answers:
+            failures += 1
+            print("User {}: {} reminders (expected {}), {} answers (expected {})".format(
+                tid, received[tid], expected_reminders, answers[tid], expected_answers))
+    print("{} workers, {} messages, {} failures".format(args.workers, len(api.sent), failures))
+    print("Cluster check {}".format("FAILED" if failures > 0 else "OK"))
+    return 1 if failures > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+from data import status_cache
+
+logger = logging.getLogger(__name__)
+
+class CommentBuffer(object):
+    """Write-behind buffer of the comments sent by the users. Only the
+    last comment of each user is kept; all the pending ones are passed
+    to writer(bot, entries) window seconds after the last one arrived,
+    but no later than max_delay seconds after the first one. With a
+    window of zero comments are written immediately.
+
+    """
+    def __init__(self, window=2.0, max_delay=10.0):
+        self.window = window
+        self.max_delay = max_delay
+        self.writer = None
+        self.lock = threading.Lock()
+        # Flushes are serialized, so that a later comment of a user is
+        # never overwritten by an earlier one
+        self.flush_lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bot = None
+        self.first_time = None
+        self.timer = None
+
+    def add(self, bot, user_id, circle_id, text, when):
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.entries[user_id] = (circle_id, text, when)
+            self.bot = bot
+            if self.window > 0:
+                now = time.time()
+                if self.first_time is None:
+                    self.first_time = now
+                delay = min(self.window, self.first_time + self.max_delay - now)
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.timer = threading.Timer(max(delay, 0.0), self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        # Let /status render the pending comment
+        status_cache.bump(circle_id)
+        if self.window <= 0:
+            self.flush()
+
+    def get_pending(self, circle_id):
+        """Return a dict from user id to (text, when) of the pending
+        comments of the members of a circle.
+
+        """
+        with self.lock:
+            return dict([(user_id, (text, when)) for user_id, (entry_circle_id, text, when) in self.entries.items()
+                         if entry_circle_id == circle_id])
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                entries = self.entries
+                self.entries = collections.OrderedDict()
+                self.first_time = None
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                bot = self.bot
+            if len(entries) == 0:
+                return
+            try:
+                self.writer(bot, [(user_id, text, when) for user_id, (_, text, when) in entries.items()])
+            except Exception:
+                logger.exception("Cannot write %d comments", len(entries))
+
+comments = CommentBuffer()
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+def get_config(name, default=None, convert=str):
+    """Read a configuration value from the file with the given name in
+    the working directory, like database_url and telegram_token, or
+    return default if the file does not exist.
+
+    """
+    if not os.path.exists(name):
+        return default
+    return convert(open(name).read().strip())
@@ -1,14 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from telegram.ext import Updater, CommandHandler
-import logging
-import datetime
-
-from data import SessionGen, create_db, User, Phase, Statement, Circle, Moment
+from migrations import upgrade
 
 def main():
-    create_db()
+    upgrade()
 
 if __name__ == '__main__':
     main()
@@ -1,21 +1,141 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import create_engine, Column, Integer, ForeignKey, DateTime, UniqueConstraint, Boolean, Date, Unicode, Time, text
+from sqlalchemy import create_engine, Column, Integer, ForeignKey, DateTime, UniqueConstraint, Boolean, Date, Unicode, Time, text, and_, func, case, exists
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.schema import Index
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import session as sessionlib
-from sqlalchemy.orm.session import object_session
+from sqlalchemy.orm.session import object_session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy import event, inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
 
 import datetime
+import threading
 
-db = create_engine(open('database_url').read().strip(), echo=False)
-Session = sessionmaker(db)
-Base = declarative_base(db)
+from schedule import ScheduleCache, ScheduleIndex
+from identity import IdentityCache
+from status import StatusCache
+from config import get_config
+
+def is_sqlite_memory(url):
+    url = make_url(url)
+    return url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')
+
+def make_engine(url, read_only=False):
+    """Create an engine configured by the db_* and sqlite_* files. On
+    SQLite the pragmas are set on every new connection; the connections
+    of a read_only engine refuse writes.
+
+    """
+    kwargs = {'echo': False}
+    backend = make_url(url).get_backend_name()
+    if is_sqlite_memory(url):
+        # A single connection shared by all threads, otherwise each of
+        # them would see its own empty database
+        kwargs['poolclass'] = StaticPool
+        kwargs['connect_args'] = {'check_same_thread': False}
+    else:
+        kwargs['pool_size'] = get_config('db_pool_size', 5, int)
+        kwargs['max_overflow'] = get_config('db_max_overflow', 10, int)
+        kwargs['pool_timeout'] = get_config('db_pool_timeout', 30.0, float)
+        if backend == 'sqlite':
+            # SQLAlchemy would not pool SQLite file connections at all
+            kwargs['poolclass'] = QueuePool
+            kwargs['connect_args'] = {'check_same_thread': False}
+    engine = create_engine(url, **kwargs)
+
+    if backend == 'sqlite':
+        pragmas = [('journal_mode', get_config('sqlite_journal_mode', 'wal')),
+                   ('busy_timeout', get_config('sqlite_busy_timeout', 5000, int)),
+                   ('synchronous', get_config('sqlite_synchronous', 'normal'))]
+        if read_only:
+            pragmas.append(('query_only', 'on'))
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            cursor.close()
+    elif read_only and backend == 'postgresql':
+        @event.listens_for(engine, 'connect')
+        def set_read_only(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+            cursor.close()
+            dbapi_connection.commit()
+
+    return engine
+
+class EngineFactory(object):
+    """Creates the engines on first use, so that importing this module
+    does not touch the configuration or the database. The URLs are read
+    from database_url and replica_url unless configure() is called
+    before.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url = None
+        self.replica_url = None
+        self.engine = None
+        self.read_engine = None
+
+    def configure(self, url=None, replica_url=None):
+        with self.lock:
+            if self.engine is not None:
+                raise RuntimeError("The engine was already created")
+            self.url = url
+            self.replica_url = replica_url
+
+    def get_engine(self):
+        with self.lock:
+            if self.engine is None:
+                url = self.url or get_config('database_url')
+                if url is None:
+                    raise RuntimeError("No database_url configured")
+                self.engine = make_engine(url)
+                # Read-only sessions use the replica, if any; an
+                # in-memory database cannot be opened twice
+                if is_sqlite_memory(url):
+                    self.read_engine = self.engine
+                else:
+                    self.read_engine = make_engine(self.replica_url or get_config('replica_url', url), read_only=True)
+            return self.engine
+
+    def get_read_engine(self):
+        self.get_engine()
+        return self.read_engine
+
+    def has_replica(self):
+        return self.get_read_engine().url != self.get_engine().url
+
+engines = EngineFactory()
+get_engine = engines.get_engine
+get_read_engine = engines.get_read_engine
+Session = sessionmaker()
+
+def can_cache(session):
+    """Data read from a replica may lag behind the invalidations, so it
+    must not be put in the caches.
+
+    """
+    return not session.info.get('replica', False)
+Base = declarative_base()
+schedule_cache = ScheduleCache()
+identity_cache = IdentityCache()
+status_cache = StatusCache()
 
 def create_db():
-    Base.metadata.create_all(db)
+    """Create the missing tables; the columns added to existing ones
+    are left to migrations.upgrade().
+
+    """
+    Base.metadata.create_all(get_engine())
 
 class Circle(Base):
     __tablename__ = 'circles'
@@ -29,61 +149,91 @@ class Circle(Base):
     join_code = Column(Unicode, nullable=True, default=None, server_default=text('null'))
     bottom_line = Column(Unicode, nullable=True, default=None, server_default=text('null'))
 
-    def get_current_phase(self, when=None, successive=False):
+    @staticmethod
+    def get_schedule_index_by_id(session, circle_id):
+        index = schedule_cache.get_index(circle_id)
+        if index is None:
+            moments = session.query(Moment.time, Moment.id).filter(Moment.circle_id == circle_id).all()
+            if can_cache(session):
+                index = schedule_cache.set_index(circle_id, moments)
+            else:
+                index = ScheduleIndex(moments)
+        return index
+
+    def get_schedule_index(self):
+        return Circle.get_schedule_index_by_id(object_session(self), self.id)
+
+    def get_current_phase(self, when=None, successive=False, create=False):
+        """Return the current (or successive) phase. Phases are normally
+        created in advance by pregenerate_phases(); if one is missing it
+        is inserted only when create is true, otherwise a transient
+        Phase is returned, which has no statements.
+
+        """
         if when is None:
             when = datetime.datetime.now()
-        if successive:
-            moment = self.moments[0]
-            prev_date = False
-        else:
-            moment = self.moments[-1]
-            prev_date = True
-        for moment2 in self.moments:
-            if moment2.time <= when.time():
-                if not successive:
-                    moment = moment2
-                    prev_date = False
-            else:
-                if successive:
-                    moment = moment2
-                    prev_date = False
-                break
-        date = when.date()
-        if prev_date:
-            date -= datetime.timedelta(days=1)
+        moment_id, date = self.get_schedule_index().resolve(when, successive=successive)
         session = object_session(self)
+        phase_id = schedule_cache.get_phase_id(moment_id, date)
+        if phase_id is not None:
+            return Phase.attach(session, phase_id, moment_id, date)
         try:
             phase = session.query(Phase).filter(Phase.date == date). \
-                filter(Phase.moment == moment).one()
+                filter(Phase.moment_id == moment_id).one()
         except NoResultFound:
             phase = Phase()
             phase.date = date
-            phase.moment = moment
-            session.add(phase)
+            phase.moment = session.query(Moment).get(moment_id)
+            if create:
+                session.add(phase)
+                session.flush()
+                session.add(PhaseTally.build(session, phase.id))
+                session.flush()
+                # Only cache it once it is committed; the status
+                # rendered while the phase was missing is dropped
+                session.info.setdefault('new_phases', []).append((moment_id, date, phase.id))
+                session.info.setdefault('changed_circles', set()).add(self.id)
+                _broadcast(session, 'circle', self.id)
+        else:
+            if (moment_id, date, phase.id) not in session.info.get('new_phases', []):
+                schedule_cache.set_phase_id(moment_id, date, phase.id)
 
         return phase
 
     def get_current_statements(self, when=None):
+        return self.get_status(when=when).statements
+
+    def get_current_nonvoters(self, when=None):
+        return self.get_status(when=when).nonvoters
+
+    def get_status(self, when=None):
         if when is None:
             when = datetime.datetime.now()
         phase = self.get_current_phase(when=when)
         session = object_session(self)
-        statements = session.query(Statement).join(User).filter(User.circle == self).filter(Statement.phase == phase).all()
-        #statements = session.query(User).outerjoin(Statement).filter(User.circle == self).filter(Statement.phase == phase).all()
-        return statements
+        rows = session.query(User, Statement, effective_choice()). \
+            outerjoin(Statement, and_(Statement.user_id == User.id, Statement.phase_id == phase.id)). \
+            filter(User.circle_id == self.id).order_by(User.id).all()
+        return CircleStatus(phase, rows)
 
-    def get_current_nonvoters(self, when=None):
+    def get_tally(self, phase):
+        return PhaseTally.get(object_session(self), phase)
+
+    def get_reminder_targets(self, when=None):
+        """Return the enabled members that asked for reminders, have
+        not made any statement for the current phase yet and have no
+        default choice.
+
+        """
         if when is None:
             when = datetime.datetime.now()
         phase = self.get_current_phase(when=when)
         session = object_session(self)
-        # TODO - Use a real query
-        users = session.query(User).filter(User.circle == self).all()
-        nonvoters = []
-        for user in users:
-            if user.get_current_statement(when=when) is None:
-                nonvoters.append(user)
-        return nonvoters
+        return session.query(User). \
+            outerjoin(Statement, and_(Statement.user_id == User.id, Statement.phase_id == phase.id)). \
+            filter(User.circle_id == self.id).filter(User.reminder == True). \
+            filter(User.enabled == True).filter(Statement.id == None). \
+            filter(effective_choice() == None).all()
 
 class Moment(Base):
     __tablename__ = 'moments'
@@ -100,10 +250,24 @@ class Moment(Base):
 
     circle = relationship(Circle, backref=backref("moments", order_by="Moment.time"))
 
+@event.listens_for(Moment, 'after_insert')
+@event.listens_for(Moment, 'after_update')
+@event.listens_for(Moment, 'after_delete')
+def _record_moment_change(mapper, connection, target):
+    # Caches are invalidated only once the change is committed; the
+    # moment could also have been moved away from another circle
+    circle_ids = set([target.circle_id] + list(inspect(target).attrs.circle_id.history.deleted))
+    session = object_session(target)
+    changes = session.info.setdefault('changed_moments', [])
+    for circle_id in circle_ids:
+        changes.append((circle_id, target.id))
+        _broadcast(session, 'moment', circle_id, target.id)
+
 class User(Base):
     __tablename__ = 'users'
     __table_args__ = (
         UniqueConstraint('tid', name="const_user_tid"),
+        Index('ix_users_circle_id', 'circle_id'),
     )
 
     id = Column(Integer, primary_key=True)
@@ -116,21 +280,43 @@ class User(Base):
     default_choice = Column(Boolean, nullable=True, default=None, server_default=text('null'))
     reminder = Column(Boolean, nullable=False, default=False, server_default=text('false'))
     loud = Column(Boolean, nullable=False, default=False, server_default=text('false'))
+    digest = Column(Boolean, nullable=False, default=False, server_default=text('false'))
 
     circle = relationship(Circle, backref="members")
 
     def get_pretty_name(self):
         return self.first_name + ' ' + self.last_name
 
+    def set_circle(self, circle):
+        old_circle_id = self.circle_id
+        self.circle = circle
+        new_circle_id = circle.id if circle is not None else None
+        if old_circle_id != new_circle_id:
+            PhaseTally.move_user(object_session(self), self.id, old_circle_id, new_circle_id, self.default_choice)
+
+    def set_default_choice(self, default_choice):
+        """Change the choice assumed for the phases in which the user
+        has not expressed any, which can be True (present), False
+        (absent) or None (no default).
+
+        """
+        if self.circle_id is not None and default_choice != self.default_choice:
+            PhaseTally.apply_default(object_session(self), self.id, self.circle_id,
+                                     [(choice_from_default(self.default_choice), -1),
+                                      (choice_from_default(default_choice), 1)])
+        self.default_choice = default_choice
+
     def get_current_statement(self, when=None, for_update=False, successive=False):
         if when is None:
             when = datetime.datetime.now()
         if self.circle is None:
             return None
-        phase = self.circle.get_current_phase(when=when, successive=successive)
+        phase = self.circle.get_current_phase(when=when, successive=successive, create=for_update)
         session = object_session(self)
         try:
-            statement = session.query(Statement).filter(Statement.user == self).filter(Statement.phase == phase).one()
+            if phase.id is None:
+                raise NoResultFound()
+            statement = session.query(Statement).filter(Statement.user == self).filter(Statement.phase_id == phase.id).one()
         except NoResultFound:
             if for_update:
                 statement = Statement()
@@ -146,20 +332,67 @@ class User(Base):
         return statement
 
     @classmethod
-    def get_from_telegram_user(cls, session, tg_user):
-        try:
-            user = session.query(User).filter(User.tid == tg_user.id).one()
-        except NoResultFound:
-            user = User()
-            user.tid = tg_user.id
-            user.first_name = tg_user.first_name
-            user.last_name = tg_user.last_name
-            user.username = tg_user.username
-            user.enabled = True
+    def attach(cls, session, values):
+        """Return the user whose columns have the given values, without
+        loading it from the database.
+
+        """
+        user = session.identity_map.get(identity_key(cls, values['id']))
+        if user is None:
+            user = cls()
+            for key, value in values.items():
+                setattr(user, key, value)
+            make_transient_to_detached(user)
             session.add(user)
+        return user
+
+    def get_values(self):
+        return dict([(column.key, getattr(self, column.key)) for column in User.__table__.columns])
+
+    @classmethod
+    def get_from_telegram_user(cls, session, tg_user):
+        values = identity_cache.get(tg_user.id)
+        if values is not None:
+            return cls.attach(session, values)
+        generation = identity_cache.get_generation(tg_user.id)
+        user = session.query(User).filter(User.tid == tg_user.id).one_or_none()
+        if user is None:
+            values = cls.create_from_telegram_user(tg_user)
+            if values is None:
+                # Someone else created it first
+                with SessionGen() as primary:
+                    values = primary.query(User).filter(User.tid == tg_user.id).one().get_values()
+            # Either way the values come from the primary: the caller's
+            # session may be reading from a replica that lags behind
+            user = cls.attach(session, values)
+        if can_cache(session):
+            identity_cache.set(tg_user.id, generation, user.get_values())
 
         return user
 
+    @classmethod
+    def create_from_telegram_user(cls, tg_user):
+        """Create the user in a separate transaction, so that if another
+        update from the same Telegram user creates it first the conflict
+        does not spoil the caller's transaction. Return the values of
+        the new user, or None in case of conflict.
+
+        """
+        try:
+            with SessionGen(True) as session:
+                user = User()
+                user.tid = tg_user.id
+                user.first_name = tg_user.first_name
+                user.last_name = tg_user.last_name
+                user.username = tg_user.username
+                user.enabled = True
+                session.add(user)
+                session.flush()
+                values = user.get_values()
+        except IntegrityError:
+            return None
+        return values
+
 class Phase(Base):
     __tablename__ = 'phases'
     __table_args__ = (
@@ -172,13 +405,70 @@ class Phase(Base):
 
     moment = relationship(Moment)
 
+    @classmethod
+    def attach(cls, session, phase_id, moment_id, date):
+        """Return the phase with the given id, trusting the cached
+        moment_id and date instead of loading it from the database.
+
+        """
+        phase = session.identity_map.get(identity_key(cls, phase_id))
+        if phase is None:
+            phase = cls()
+            phase.id = phase_id
+            phase.moment_id = moment_id
+            phase.date = date
+            make_transient_to_detached(phase)
+            session.add(phase)
+        return phase
+
     def get_pretty_name(self):
         return self.moment.name + ' ' + self.date.strftime('%d/%m/%Y')
 
+def sync_schedule(session):
+    """Reload the moments, which are few, and invalidate the cached
+    schedules of those that changed since the last call, whoever wrote
+    them. Return the number of changed moments.
+
+    """
+    return schedule_cache.sync(session.query(Moment.id, Moment.circle_id, Moment.time, Moment.reminder_time).all())
+
+def pregenerate_phases(session, days, today=None):
+    """Insert the phases of every moment from yesterday up to days
+    days ahead, using a single batched insert. Return the number of
+    created phases.
+
+    """
+    if today is None:
+        today = datetime.date.today()
+    first = today - datetime.timedelta(days=1)
+    last = today + datetime.timedelta(days=days)
+    existing = set(session.query(Phase.moment_id, Phase.date). \
+                   filter(Phase.date >= first).filter(Phase.date <= last))
+    rows = []
+    circle_ids = set()
+    for moment_id, circle_id in session.query(Moment.id, Moment.circle_id):
+        date = first
+        while date <= last:
+            if (moment_id, date) not in existing:
+                rows.append({'moment_id': moment_id, 'date': date})
+                circle_ids.add(circle_id)
+            date += datetime.timedelta(days=1)
+    if len(rows) > 0:
+        session.info.setdefault('changed_circles', set()).update(circle_ids)
+        session.execute(Phase.__table__.insert(), rows)
+        # The new tallies start from the default choices of the members
+        missing = PhaseTally.expected(session). \
+            filter(Phase.date >= first).filter(Phase.date <= last). \
+            filter(~exists().where(PhaseTally.phase_id == Phase.id))
+        session.execute(PhaseTally.__table__.insert().from_select(
+            ['phase_id', 'circle_id', 'presents', 'absents', 'known_total', 'no_answers'], missing.statement))
+    return len(rows)
+
 class Statement(Base):
     __tablename__ = 'statements'
     __table_args__ = (
         UniqueConstraint('user_id', 'phase_id', name="const_statement_user_phase"),
+        Index('ix_statements_phase_id', 'phase_id'),
         )
 
     id = Column(Integer, primary_key=True)
@@ -191,8 +481,456 @@ class Statement(Base):
     user = relationship(User)
     phase = relationship(Phase)
 
-    def get_pretty_name(self):
-        return self.user.get_pretty_name() + (('+{}'.format(self.choice-1)) if self.choice is not None and self.choice > 1 else '') + ((' (' + self.comment + ')') if self.comment is not None else '')
+    def set_choice(self, choice):
+        session = object_session(self)
+        phase_id = self.phase_id if self.phase_id is not None else self.phase.id
+        if self.id is None:
+            old_choice = None
+            self.choice = choice
+        else:
+            # The stored choice is replaced only if it is still the one
+            # read, otherwise a concurrent change of the same statement
+            # would make both take the same old choice out of the tally
+            table = Statement.__table__
+            while True:
+                old_choice = self.choice
+                result = session.execute(table.update().where(table.c.id == self.id). \
+                    where(table.c.choice == old_choice).values(choice=choice))
+                if result.rowcount > 0:
+                    break
+                session.expire(self, ['choice'])
+            set_committed_value(self, 'choice', choice)
+        # Without an explicit choice the tally counts the default one
+        default = choice_from_default(self.user.default_choice)
+        old_choice = old_choice if old_choice is not None else default
+        new_choice = choice if choice is not None else default
+        PhaseTally.apply(session, phase_id, [(old_choice, -1), (new_choice, 1)])
+
+    def get_pretty_name(self, comment=None):
+        if comment is None:
+            comment = self.comment
+        return self.user.get_pretty_name() + (('+{}'.format(self.choice-1)) if self.choice is not None and self.choice > 1 else '') + ((' (' + comment + ')') if comment is not None else '')
+
+def choice_from_default(default_choice):
+    if default_choice is None:
+        return None
+    return 1 if default_choice else 0
+
+def effective_choice():
+    """Return the SQL expression of the choice of a user for a phase:
+    the one of their statement or, when they did not express any, the
+    one implied by User.default_choice.
+
+    """
+    return func.coalesce(Statement.choice, case([(User.default_choice == True, 1),
+                                                 (User.default_choice == False, 0)], else_=None))
+
+class PhaseTally(Base):
+    """Counts of the choices of the members of the circle of a phase,
+    including the default ones, kept up to date in the same transaction
+    as the statements.
+
+    """
+    __tablename__ = 'phase_tallies'
+    __table_args__ = (
+        Index('ix_phase_tallies_circle_id', 'circle_id'),
+        )
+
+    phase_id = Column(Integer, ForeignKey(Phase.id, onupdate="CASCADE", ondelete="CASCADE", name="fk_tally_phase"), primary_key=True)
+    circle_id = Column(Integer, ForeignKey(Circle.id, onupdate="CASCADE", ondelete="CASCADE", name="fk_tally_circle"), nullable=False)
+    presents = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    absents = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    known_total = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    # Members that did not answer, either explicitly or by default
+    no_answers = Column(Integer, nullable=False, default=0, server_default=text('0'))
+
+    @classmethod
+    def _increments(cls, changes):
+        deltas = {'presents': 0, 'absents': 0, 'known_total': 0, 'no_answers': 0}
+        for choice, sign in changes:
+            if choice is None:
+                deltas['no_answers'] += sign
+            elif choice > 0:
+                deltas['presents'] += sign
+                deltas['known_total'] += sign * choice
+            else:
+                deltas['absents'] += sign
+        table = cls.__table__
+        return dict([(name, table.c[name] + delta) for name, delta in deltas.items() if delta != 0])
+
+    @classmethod
+    def apply(cls, session, phase_id, changes):
+        """Apply a list of (choice, sign) pairs to the tally of a
+        phase, where sign is 1 for a choice being added and -1 for a
+        choice being removed. The change must already be written (or
+        pending in the session), since a missing tally is built from
+        the statements and then already includes it.
+
+        """
+        increments = cls._increments(changes)
+        if len(increments) == 0:
+            return
+        table = cls.__table__
+        result = session.execute(table.update().where(table.c.phase_id == phase_id).values(**increments))
+        if result.rowcount == 0:
+            # The phase predates the tallies: build it from the
+            # statements, which autoflushes the change being applied
+            session.add(cls.build(session, phase_id))
+            session.flush()
+
+    @classmethod
+    def expected(cls, session):
+        """Return a query computing the tallies from the statements and
+        the default choices, counting only the users that are still in
+        the phase's circle.
+
+        """
+        choice = effective_choice()
+        return session.query(Phase.id, Moment.circle_id,
+                               func.coalesce(func.sum(case([(choice > 0, 1)], else_=0)), 0),
+                               func.coalesce(func.sum(case([(choice == 0, 1)], else_=0)), 0),
+                               func.coalesce(func.sum(case([(choice > 0, choice)], else_=0)), 0),
+                               func.coalesce(func.sum(case([(and_(User.id != None, choice == None), 1)], else_=0)), 0)). \
+            join(Moment, Phase.moment_id == Moment.id). \
+            outerjoin(User, User.circle_id == Moment.circle_id). \
+            outerjoin(Statement, and_(Statement.phase_id == Phase.id, Statement.user_id == User.id)). \
+            group_by(Phase.id, Moment.circle_id)
+
+    @classmethod
+    def build(cls, session, phase_id):
+        phase_id, circle_id, presents, absents, known_total, no_answers = cls.expected(session). \
+            filter(Phase.id == phase_id).one()
+        return cls(phase_id=phase_id, circle_id=circle_id, presents=presents, absents=absents,
+                   known_total=known_total, no_answers=no_answers)
+
+    @classmethod
+    def get(cls, session, phase):
+        """Return the tally of a phase. A missing one is computed as in
+        expected(), without storing it; if the phase itself does not
+        exist yet, only the default choices of the members count.
+
+        """
+        if phase.id is not None:
+            tally = session.query(cls).get(phase.id)
+            if tally is None:
+                tally = cls.build(session, phase.id)
+            return tally
+        circle_id = phase.moment.circle_id
+        presents, absents, no_answers = session.query(
+            func.coalesce(func.sum(case([(User.default_choice == True, 1)], else_=0)), 0),
+            func.coalesce(func.sum(case([(User.default_choice == False, 1)], else_=0)), 0),
+            func.coalesce(func.sum(case([(User.default_choice == None, 1)], else_=0)), 0)). \
+            filter(User.circle_id == circle_id).one()
+        return cls(phase_id=None, circle_id=circle_id, presents=presents, absents=absents,
+                   known_total=presents, no_answers=no_answers)
+
+    @classmethod
+    def apply_default(cls, session, user_id, circle_id, changes):
+        """Apply a list of (choice, sign) pairs, as in apply(), to the
+        tallies of all the phases of a circle in which the user has not
+        expressed a choice, with a single statement.
+
+        """
+        increments = cls._increments(changes)
+        if len(increments) == 0:
+            return
+        table = cls.__table__
+        explicit = session.query(Statement.phase_id).filter(Statement.user_id == user_id). \
+            filter(Statement.choice != None)
+        session.execute(table.update().where(table.c.circle_id == circle_id). \
+            where(~table.c.phase_id.in_(explicit.subquery())).values(**increments))
+
+    @classmethod
+    def move_user(cls, session, user_id, old_circle_id, new_circle_id, default_choice=None):
+        """Update the tallies when a user leaves old_circle_id and joins
+        new_circle_id (either of them may be None).
+
+        """
+        for circle_id, sign in [(old_circle_id, -1), (new_circle_id, 1)]:
+            if circle_id is None:
+                continue
+            cls.apply_default(session, user_id, circle_id, [(choice_from_default(default_choice), sign)])
+            statements = session.query(Statement.phase_id, Statement.choice). \
+                join(Phase, Statement.phase_id == Phase.id).join(Moment, Phase.moment_id == Moment.id). \
+                filter(Statement.user_id == user_id).filter(Moment.circle_id == circle_id). \
+                filter(Statement.choice != None).all()
+            for phase_id, choice in statements:
+                cls.apply(session, phase_id, [(choice, sign)])
+
+class PhaseRollup(Base):
+    """Monthly summary of the statements of a user in a circle, which
+    replaces the phases and statements older than the archiving
+    horizon.
+
+    """
+    __tablename__ = 'phase_rollups'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'circle_id', 'month', name="const_rollup_user_circle_month"),
+        )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey(User.id, onupdate="CASCADE", ondelete="CASCADE", name="fk_rollup_user"), nullable=False)
+    circle_id = Column(Integer, ForeignKey(Circle.id, onupdate="CASCADE", ondelete="CASCADE", name="fk_rollup_circle"), nullable=False)
+    month = Column(Date, nullable=False)
+    presents = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    absents = Column(Integer, nullable=False, default=0, server_default=text('0'))
+    no_answers = Column(Integer, nullable=False, default=0, server_default=text('0'))
+
+    circle = relationship(Circle)
+
+    @classmethod
+    def add(cls, session, user_id, circle_id, month, presents, absents, no_answers):
+        table = cls.__table__
+        result = session.execute(table.update(). \
+            where(and_(table.c.user_id == user_id, table.c.circle_id == circle_id, table.c.month == month)).values(
+                presents=table.c.presents + presents,
+                absents=table.c.absents + absents,
+                no_answers=table.c.no_answers + no_answers))
+        if result.rowcount == 0:
+            session.execute(table.insert().values(user_id=user_id, circle_id=circle_id, month=month,
+                                                  presents=presents, absents=absents, no_answers=no_answers))
+
+def check_tallies(session, fix=False):
+    """Compare the tallies with the ones computed from the statements
+    and return the list of (phase_id, stored, expected) tuples that
+    differ. If fix is true, the stored tallies are corrected.
+
+    """
+    stored = dict([(tally.phase_id, tally) for tally in session.query(PhaseTally)])
+    drifts = []
+    for phase_id, circle_id, presents, absents, known_total, no_answers in PhaseTally.expected(session):
+        expected = (circle_id, presents, absents, known_total, no_answers)
+        tally = stored.pop(phase_id, None)
+        actual = None if tally is None else (tally.circle_id, tally.presents, tally.absents, tally.known_total, tally.no_answers)
+        if actual != expected:
+            drifts.append((phase_id, actual, expected))
+            if fix:
+                if tally is None:
+                    tally = PhaseTally(phase_id=phase_id)
+                    session.add(tally)
+                tally.circle_id, tally.presents, tally.absents, tally.known_total, tally.no_answers = expected
+    for phase_id, tally in stored.items():
+        drifts.append((phase_id, (tally.circle_id, tally.presents, tally.absents, tally.known_total, tally.no_answers), None))
+        if fix:
+            session.delete(tally)
+    return drifts
+
+class Lease(Base):
+    """Named lease held by one process at a time until it expires,
+    used to elect the process that runs the jobs.
+
+    """
+    __tablename__ = 'leases'
+
+    name = Column(Unicode, primary_key=True)
+    holder = Column(Unicode, nullable=False)
+    expires = Column(DateTime, nullable=False)
+
+    @classmethod
+    def acquire(cls, name, holder, duration, now=None):
+        """Acquire or renew the lease for duration seconds; return
+        whether holder holds it.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=duration)
+        table = cls.__table__
+        with SessionGen(True) as session:
+            result = session.execute(table.update(). \
+                where(table.c.name == name).where((table.c.holder == holder) | (table.c.expires < now)). \
+                values(holder=holder, expires=expires))
+            if result.rowcount > 0:
+                return True
+        try:
+            with SessionGen(True) as session:
+                session.execute(table.insert().values(name=name, holder=holder, expires=expires))
+        except IntegrityError:
+            return False
+        return True
+
+class SentReminder(Base):
+    """Marks the phases whose reminder was already sent, so that it is
+    sent once even if more processes try.
+
+    """
+    __tablename__ = 'sent_reminders'
+
+    phase_id = Column(Integer, ForeignKey(Phase.id, onupdate="CASCADE", ondelete="CASCADE", name="fk_sent_reminder_phase"), primary_key=True)
+    time = Column(DateTime, nullable=False)
+
+    @classmethod
+    def claim(cls, moment_id, when):
+        """Record that the reminder of the current phase of a moment is
+        being sent; return False if it was already.
+
+        """
+        try:
+            with SessionGen(True) as session:
+                moment = session.query(Moment).get(moment_id)
+                phase = moment.circle.get_current_phase(when=when, create=True)
+                session.add(cls(phase_id=phase.id, time=when))
+        except IntegrityError:
+            return False
+        return True
+
+class CacheChange(Base):
+    """Log of the changes that invalidate the caches, written by each
+    process in the transaction making the change and polled by the
+    others; the id works as a version number.
+
+    """
+    __tablename__ = 'cache_changes'
+
+    id = Column(Integer, primary_key=True)
+    origin = Column(Unicode, nullable=False)
+    kind = Column(Unicode, nullable=False)
+    key = Column(Integer, nullable=False)
+    subkey = Column(Integer, nullable=True)
+    time = Column(DateTime, nullable=False)
+
+class ChangeFeed(object):
+    """Applies to the local caches the changes logged by the other
+    processes. Changes are written only once origin is set.
+
+    Ids are not necessarily committed in order, so each poll reads again
+    the last overlap ids and skips the ones already applied.
+
+    """
+    def __init__(self, overlap=100):
+        self.overlap = overlap
+        self.origin = None
+        self.last_id = None
+        self.applied = set()
+
+    def enable(self, origin):
+        self.origin = origin
+
+    def poll(self, session):
+        """Apply the new changes; return how many were applied."""
+        first_id, max_id = session.query(func.min(CacheChange.id), func.max(CacheChange.id)).one()
+        if self.last_id is None:
+            self.last_id = max_id or 0
+            return 0
+        if first_id is not None and first_id > self.last_id + 1:
+            # Some changes were pruned before being seen
+            schedule_cache.clear()
+            identity_cache.clear()
+            status_cache.clear()
+        count = 0
+        for change in session.query(CacheChange).filter(CacheChange.id > self.last_id - self.overlap). \
+                order_by(CacheChange.id):
+            if change.id in self.applied:
+                continue
+            self.applied.add(change.id)
+            self.last_id = max(self.last_id, change.id)
+            if change.origin == self.origin:
+                continue
+            if change.kind == 'moment':
+                schedule_cache.invalidate_moment(change.key, change.subkey)
+            elif change.kind == 'user':
+                identity_cache.invalidate(change.key)
+            elif change.kind == 'circle':
+                status_cache.bump(change.key)
+            count += 1
+        self.applied = set([change_id for change_id in self.applied if change_id > self.last_id - self.overlap])
+        return count
+
+    def prune(self, session, age):
+        """Delete the changes older than age seconds."""
+        limit = datetime.datetime.now() - datetime.timedelta(seconds=age)
+        return session.query(CacheChange).filter(CacheChange.time < limit).delete(synchronize_session=False)
+
+change_feed = ChangeFeed()
+
+class CircleStatus(object):
+    """Snapshot of the statements of a circle for a single phase,
+    computed with one outer join of the members to their statements.
+
+    """
+    def __init__(self, phase, rows):
+        self.phase = phase
+        # Keeping the users referenced also keeps them in the identity
+        # map, so that Statement.user does not need to load them again
+        self.members = [user for user, _, _ in rows]
+        self.statements = [st for _, st, _ in rows if st is not None]
+        self.nonvoters = [user for user, st, choice in rows if st is None and choice is None]
+        self.presents = []
+        self.absents = []
+        self.unknowns = []
+        for user, st, choice in rows:
+            if st is None:
+                if choice is None:
+                    continue
+                # Stands for the default choice, it is never added to
+                # the session
+                st = Statement(user=user, choice=choice)
+            if choice is None:
+                self.unknowns.append(st)
+            elif choice > 0:
+                self.presents.append(st)
+            else:
+                self.absents.append(st)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _record_user_change(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault('changed_users', []).append(target.tid)
+    _broadcast(session, 'user', target.tid)
+    circle_ids = set([target.circle_id] + list(inspect(target).attrs.circle_id.history.deleted))
+    session.info.setdefault('changed_circles', set()).update(circle_ids)
+    for circle_id in circle_ids:
+        _broadcast(session, 'circle', circle_id)
+
+@event.listens_for(Circle, 'after_update')
+def _record_circle_change(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault('changed_circles', set()).add(target.id)
+    _broadcast(session, 'circle', target.id)
+
+@event.listens_for(Statement, 'after_insert')
+@event.listens_for(Statement, 'after_update')
+@event.listens_for(Statement, 'after_delete')
+def _record_statement_change(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault('changed_circles', set()).add(target.user.circle_id)
+    _broadcast(session, 'circle', target.user.circle_id)
+
+def _broadcast(session, kind, key, subkey=None):
+    if change_feed.origin is not None and key is not None:
+        session.info.setdefault('broadcast', set()).add((kind, key, subkey))
+
+@event.listens_for(Session, 'after_flush')
+def _write_broadcast(session, flush_context):
+    # The changes are written in the same transaction, so that other
+    # processes see them exactly when they are committed
+    changes = session.info.pop('broadcast', None)
+    if changes:
+        now = datetime.datetime.now()
+        session.execute(CacheChange.__table__.insert(), [
+            {'origin': change_feed.origin, 'kind': kind, 'key': key, 'subkey': subkey, 'time': now}
+            for kind, key, subkey in sorted(changes)])
+
+@event.listens_for(Session, 'after_commit')
+def _update_caches(session):
+    for moment_id, date, phase_id in session.info.pop('new_phases', []):
+        schedule_cache.set_phase_id(moment_id, date, phase_id)
+    for circle_id, moment_id in session.info.pop('changed_moments', []):
+        schedule_cache.invalidate_moment(circle_id, moment_id)
+    for tid in session.info.pop('changed_users', []):
+        identity_cache.invalidate(tid)
+    for circle_id in session.info.pop('changed_circles', set()):
+        if circle_id is not None:
+            status_cache.bump(circle_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('new_phases', None)
+    session.info.pop('changed_moments', None)
+    session.info.pop('changed_users', None)
+    session.info.pop('changed_circles', None)
+    session.info.pop('broadcast', None)
 
 class SessionGen(object):
     """This allows us to create handy local sessions simply with:
@@ -202,20 +940,42 @@ class SessionGen(object):
 
     and at the end the session is automatically rolled back and
     closed. If one wants to commit the session, they have to call
-    commit() explicitly.
+    commit() explicitly or pass auto_commit=True, in which case it is
+    committed unless an exception is propagating. With read_only=True
+    the session uses the read engine and cannot write.
 
     """
-    def __init__(self, auto_commit=False):
+    def __init__(self, auto_commit=False, read_only=False):
         self.session = None
         self.auto_commit = auto_commit
+        self.read_only = read_only
 
     def __enter__(self):
-        self.session = Session()
+        if self.read_only:
+            self.session = Session(bind=get_read_engine(), info={'read_only': True, 'replica': engines.has_replica()})
+        else:
+            self.session = Session(bind=get_engine())
         return self.session
 
-    def __exit__(self, unused1, unused2, unused3):
-        if self.auto_commit:
-            self.session.commit()
-        else:
-            self.session.rollback()
-        self.session.close()
+    def __exit__(self, exc_type, unused2, unused3):
+        try:
+            if self.auto_commit and exc_type is None:
+                self.session.commit()
+            else:
+                self.session.rollback()
+        finally:
+            self.session.close()
+
+def retry_on_conflict(func, attempts=3):
+    """Call func(), which is expected to run a whole transaction, again
+    when it fails because of a uniqueness conflict with a concurrent
+    transaction (e.g., two of them creating the same Phase or
+    Statement), and return its result.
+
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
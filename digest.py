@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+from outbound import outbox
+
+class DigestBuffer(object):
+    """Buffer of the notifications for the recipients that asked for a
+    digest. The first notification for a recipient starts a window of
+    window seconds, at the end of which all of them are sent in a single
+    message. Notifications with the same key (i.e., the same user
+    changing the same thing) replace each other.
+
+    """
+    def __init__(self, window=300.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timers = {}
+
+    def add(self, bot, chat_id, key, text):
+        with self.lock:
+            if chat_id not in self.pending:
+                self.pending[chat_id] = collections.OrderedDict()
+                timer = threading.Timer(self.window, self.flush, args=(bot, chat_id))
+                timer.daemon = True
+                self.timers[chat_id] = timer
+                timer.start()
+            entries = self.pending[chat_id]
+            entries.pop(key, None)
+            entries[key] = text
+
+    def flush(self, bot, chat_id):
+        with self.lock:
+            entries = self.pending.pop(chat_id, None)
+            timer = self.timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        if entries:
+            outbox.send_message(bot, chat_id=chat_id, text="News from your circle:\n" + "\n".join(entries.values()))
+
+    def flush_all(self, bot):
+        with self.lock:
+            chat_ids = list(self.pending.keys())
+        for chat_id in chat_ids:
+            self.flush(bot, chat_id)
+
+digest = DigestBuffer()
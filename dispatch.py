@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+from telegram.ext import Dispatcher
+import collections
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class KeyedExecutor(object):
+    """Pool of worker threads running tasks submitted with a key. Tasks
+    with the same key run one at a time, in the order they were
+    submitted, while tasks with different keys run in parallel. A key
+    of None runs the task without serializing it with anything.
+
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.running = False
+        self.threads = []
+        self.cond = threading.Condition()
+        self.queues = {}
+        # Keys with queued tasks and none running
+        self.ready = collections.deque()
+        self.counter = itertools.count()
+
+    def start(self):
+        with self.cond:
+            self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name='dispatch_{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Wait for the submitted tasks to run and stop the workers."""
+        with self.cond:
+            while len(self.queues) > 0:
+                self.cond.wait()
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def join(self):
+        with self.cond:
+            while len(self.queues) > 0:
+                self.cond.wait()
+
+    def submit(self, key, func, *args):
+        if key is None:
+            key = ('unkeyed', next(self.counter))
+        with self.cond:
+            if key not in self.queues:
+                self.queues[key] = collections.deque()
+                self.ready.append(key)
+            self.queues[key].append((func, args))
+            self.cond.notify()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while self.running and len(self.ready) == 0:
+                    self.cond.wait()
+                if len(self.ready) == 0:
+                    return
+                key = self.ready.popleft()
+                func, args = self.queues[key][0]
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Task for %r raised an exception", key)
+            with self.cond:
+                queue = self.queues[key]
+                queue.popleft()
+                if len(queue) > 0:
+                    self.ready.append(key)
+                else:
+                    del self.queues[key]
+                self.cond.notify_all()
+
+class KeyedDispatcher(Dispatcher):
+    """Dispatcher that processes the updates on a KeyedExecutor, keyed
+    by key_func(update), instead of one at a time in its own thread.
+
+    """
+    def __init__(self, bot, update_queue, key_func, workers=4, job_queue=None):
+        Dispatcher.__init__(self, bot, update_queue, workers=0, job_queue=job_queue)
+        self.key_func = key_func
+        self.executor = KeyedExecutor(workers)
+
+    def start(self):
+        self.executor.start()
+        Dispatcher.start(self)
+
+    def stop(self):
+        Dispatcher.stop(self)
+        self.executor.stop()
+
+    def process_update(self, update):
+        try:
+            key = self.key_func(update)
+        except Exception:
+            logger.exception("Cannot compute the key of an update")
+            key = None
+        self.executor.submit(key, Dispatcher.process_update, self, update)
+
+def install_keyed_dispatcher(updater, key_func, workers=4):
+    """Replace the dispatcher of updater with a KeyedDispatcher; it must
+    be called before installing the handlers.
+
+    """
+    updater.dispatcher = KeyedDispatcher(updater.bot, updater.update_queue, key_func,
+                                         workers=workers, job_queue=updater.job_queue)
+    return updater.dispatcher
+
+def get_chat_id(update):
+    for message in [update.message, update.edited_message,
+                    update.callback_query.message if update.callback_query is not None else None]:
+        if message is not None:
+            return message.chat_id
+    return 0
+
+class PartitionedDispatcher(Dispatcher):
+    """Dispatcher that does not process the updates, but forwards them
+    as JSON to one of the given queues, chosen by chat id, so that all
+    the updates of a chat go to the same worker process.
+
+    """
+    def __init__(self, bot, update_queue, queues, job_queue=None):
+        Dispatcher.__init__(self, bot, update_queue, workers=0, job_queue=job_queue)
+        self.queues = queues
+
+    def process_update(self, update):
+        if not hasattr(update, 'to_json'):
+            # Polling errors are still handled here
+            Dispatcher.process_update(self, update)
+            return
+        self.queues[get_chat_id(update) % len(self.queues)].put(update.to_json())
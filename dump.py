@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Export the database to a directory of JSONL or CSV files (one per
+table) and import it back, possibly into a different database.
+
+Tables are read in bounded chunks ordered by primary key and written as
+they are read, so memory usage does not depend on their size. The whole
+export reads from a single snapshot of the database, so the tables are
+consistent with each other even if the bot is running. Both
+operations can be resumed after an interruption: exporting again
+continues after the last chunk recorded in the .progress file next to
+each data file (from a new snapshot, so a resumed export of a running
+bot may not be consistent), while importing skips
+the rows whose primary key is not greater than the largest one already
+in the target table. Tables are imported in foreign key order, with one
+batched insert and one transaction per chunk.
+
+"""
+
+from sqlalchemy import create_engine, select, func, Boolean, Date, DateTime, Integer, Time
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import sys
+
+from data import Base, get_engine
+
+CSV_NULL = '\\N'
+
+def encode(column, value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+def decode(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    if isinstance(column.type, Date):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if isinstance(column.type, Time):
+        return datetime.datetime.strptime(value, '%H:%M:%S.%f' if '.' in value else '%H:%M:%S').time()
+    if isinstance(column.type, Boolean) and not isinstance(value, bool):
+        return value in ('True', 'true', '1')
+    if isinstance(column.type, Integer) and not isinstance(value, int):
+        return int(value)
+    return value
+
+def get_pk(table):
+    [pk] = table.primary_key.columns
+    return pk
+
+class JsonlFormat(object):
+    extension = 'jsonl'
+
+    def __init__(self, table):
+        self.table = table
+
+    def write_header(self, fout):
+        pass
+
+    def write_row(self, fout, row):
+        fout.write(json.dumps(row, sort_keys=True) + '\n')
+
+    def read_rows(self, fin):
+        for line in fin:
+            yield json.loads(line)
+
+class CsvFormat(object):
+    extension = 'csv'
+
+    def __init__(self, table):
+        self.table = table
+        self.names = [column.name for column in table.columns]
+
+    def write_header(self, fout):
+        csv.writer(fout).writerow(self.names)
+
+    def write_row(self, fout, row):
+        csv.writer(fout).writerow([CSV_NULL if row[name] is None else row[name] for name in self.names])
+
+    def read_rows(self, fin):
+        reader = csv.reader(fin)
+        names = next(reader, None)
+        for values in reader:
+            yield dict([(name, None if value == CSV_NULL else value) for name, value in zip(names, values)])
+
+FORMATS = {'jsonl': JsonlFormat, 'csv': CsvFormat}
+
+@contextlib.contextmanager
+def snapshot(engine):
+    """Yield a connection whose queries all read the same snapshot of
+    the database.
+
+    """
+    with engine.connect() as conn:
+        if engine.dialect.name == 'sqlite':
+            # pysqlite does not begin a transaction before a SELECT; in
+            # WAL mode an open read transaction does not block writers
+            conn.execute('BEGIN')
+            try:
+                yield conn
+            finally:
+                conn.execute('ROLLBACK')
+        else:
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+            with conn.begin():
+                yield conn
+
+def export_table(conn, table, directory, fmt_class, chunk):
+    fmt = fmt_class(table)
+    pk = get_pk(table)
+    path = os.path.join(directory, '{}.{}'.format(table.name, fmt.extension))
+    # The progress file records the size of the data file and the last
+    # exported key after each chunk; anything after that size was not
+    # completely written
+    progress_path = path + '.progress'
+    offset, last = 0, None
+    if os.path.exists(path) and os.path.exists(progress_path):
+        with open(progress_path) as fin:
+            progress = json.load(fin)
+        offset, last = progress['offset'], decode(pk, progress['last'])
+    count = 0
+    with open(path, 'a+', newline='') as fout:
+        fout.seek(offset)
+        fout.truncate()
+        if offset == 0:
+            fmt.write_header(fout)
+        while True:
+            query = select([table]).order_by(pk).limit(chunk)
+            if last is not None:
+                query = query.where(pk > last)
+            rows = conn.execute(query).fetchall()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                fmt.write_row(fout, dict([(column.name, encode(column, row[column])) for column in table.columns]))
+            fout.flush()
+            last = rows[-1][pk]
+            count += len(rows)
+            with open(progress_path, 'w') as progress:
+                json.dump({'offset': fout.tell(), 'last': encode(pk, last)}, progress)
+    return count
+
+def import_table(engine, table, directory, fmt_class, chunk):
+    fmt = fmt_class(table)
+    pk = get_pk(table)
+    path = os.path.join(directory, '{}.{}'.format(table.name, fmt.extension))
+    if not os.path.exists(path):
+        return 0
+    with engine.connect() as conn:
+        done = conn.execute(select([func.max(pk)])).scalar()
+    count = 0
+    batch = []
+
+    def flush():
+        with engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+        del batch[:]
+
+    with open(path, newline='') as fin:
+        for raw in fmt.read_rows(fin):
+            # Columns missing from older dumps get their default
+            row = dict([(column.name, decode(column, raw[column.name])) for column in table.columns if column.name in raw])
+            if done is not None and row[pk.name] <= done:
+                continue
+            batch.append(row)
+            if len(batch) >= chunk:
+                count += len(batch)
+                flush()
+        if len(batch) > 0:
+            count += len(batch)
+            flush()
+
+    # Explicit ids do not advance PostgreSQL sequences
+    if engine.dialect.name == 'postgresql' and isinstance(pk.type, Integer):
+        with engine.begin() as conn:
+            conn.execute("SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+                         "COALESCE((SELECT MAX({1}) FROM {0}), 1))".format(table.name, pk.name))
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import the whole database")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=sorted(FORMATS.keys()), default='jsonl')
+    parser.add_argument('--chunk', type=int, default=1000, help="rows per query and per insert")
+    parser.add_argument('--url', help="database to use instead of database_url")
+    args = parser.parse_args()
+
+    engine = create_engine(args.url) if args.url is not None else get_engine()
+    fmt_class = FORMATS[args.format]
+    if args.action == 'export':
+        if not os.path.exists(args.directory):
+            os.makedirs(args.directory)
+        with snapshot(engine) as conn:
+            for table in Base.metadata.sorted_tables:
+                count = export_table(conn, table, args.directory, fmt_class, args.chunk)
+                print("{}: exported {} rows".format(table.name, count))
+    else:
+        Base.metadata.create_all(engine)
+        for table in Base.metadata.sorted_tables:
+            count = import_table(engine, table, args.directory, fmt_class, args.chunk)
+            print("{}: imported {} rows".format(table.name, count))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
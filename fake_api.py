@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Minimal local imitation of the Telegram Bot API, to run the bot
+without network access. Point the bot_api_url configuration file to
+http://127.0.0.1:PORT/bot and the bot will talk to it.
+
+Running this file directly performs an end to end check of the webhook
+mode: run it in a directory with a scratch database_url.
+
+"""
+
+import http.server
+import json
+import logging
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _params(self):
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        if self.headers.get('content-type', '').startswith('application/json'):
+            return json.loads(body) if body else {}
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        params.update(urllib.parse.parse_qsl(body))
+        return params
+
+    def _answer(self, result):
+        body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        method = self.path.split('?')[0].rsplit('/', 1)[-1]
+        self._answer(self.server.api.call(method, self._params()))
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+class FakeApiServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class FakeBotAPI(object):
+    """Records the messages sent by the bot and serves the updates
+    pushed with add_update() through getUpdates.
+
+    """
+    def __init__(self, listen='127.0.0.1', port=0):
+        self.server = FakeApiServer((listen, port), FakeApiHandler)
+        self.server.api = self
+        self.cond = threading.Condition()
+        self.sent = []
+        self.sent_times = []
+        self.first_poll = None
+        self.updates = []
+        self.webhook_url = None
+        self.next_message_id = 1
+
+    @property
+    def url(self):
+        return 'http://{}:{}/bot'.format(*self.server.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, name='fake_api')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call(self, method, params):
+        with self.cond:
+            if method == 'getMe':
+                return {'id': 1, 'first_name': 'cibot', 'username': 'cibot'}
+            elif method == 'setWebhook':
+                self.webhook_url = params.get('url') or None
+                return True
+            elif method == 'deleteWebhook':
+                self.webhook_url = None
+                return True
+            elif method == 'getUpdates':
+                if self.first_poll is None:
+                    self.first_poll = time.time()
+                offset = int(params.get('offset') or 0)
+                # Long polling, but never hold a request for long
+                deadline = time.time() + min(float(params.get('timeout') or 0), 1.0)
+                while True:
+                    updates = [update for update in self.updates if update['update_id'] >= offset]
+                    if len(updates) > 0 or time.time() >= deadline:
+                        return updates
+                    self.cond.wait(deadline - time.time())
+            elif method == 'sendMessage':
+                chat_id = int(params['chat_id'])
+                message = {'message_id': self.next_message_id,
+                           'date': int(time.time()),
+                           'chat': {'id': chat_id, 'type': 'private'},
+                           'text': params.get('text')}
+                self.next_message_id += 1
+                self.sent.append((chat_id, params.get('text')))
+                self.sent_times.append(time.time())
+                self.cond.notify_all()
+                return message
+            else:
+                return True
+
+    def add_update(self, update):
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+
+    def wait_for_messages(self, count, timeout=10.0):
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.sent) < count and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return list(self.sent)
+
+def make_update(update_id, tid, text, first_name='Test', last_name='User'):
+    sender = {'id': tid, 'first_name': first_name, 'last_name': last_name, 'username': None}
+    message = {'message_id': update_id,
+               'date': int(time.time()),
+               'from': sender,
+               'chat': {'id': tid, 'type': 'private'},
+               'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split(' ')[0])}]
+    return {'update_id': update_id, 'message': message}
+
+def post_update(url, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    return urllib.request.urlopen(request).status
+
+def main():
+    from telegram.ext import Updater
+    import cibot
+    import webhook
+
+    logging.basicConfig(level=logging.INFO)
+    api = FakeBotAPI()
+    api.start()
+    cibot.upgrade()
+    updater = Updater(token='123:fake', base_url=api.url)
+    cibot.install_handlers(updater.dispatcher)
+    server = webhook.start_webhook(updater, port=0, url_path='hook',
+                                   webhook_url='http://127.0.0.1/hook')
+    try:
+        url = 'http://127.0.0.1:{}/hook'.format(server.server_address[1])
+        post_update(url, make_update(1, 1000001, '/start'))
+        sent = api.wait_for_messages(3)
+    finally:
+        updater.stop()
+        api.stop()
+    if api.webhook_url is None or len(sent) == 0:
+        print("Webhook check FAILED")
+        return 1
+    for chat_id, text in sent:
+        print("{}: {}".format(chat_id, text))
+    print("Webhook check OK")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
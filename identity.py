@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+class IdentityCache(object):
+    """Bounded LRU cache from Telegram ids to snapshots of the
+    corresponding rows of the users table (dictionaries of column
+    values). Each id has a generation number, bumped when it is
+    invalidated, so that a row read before an invalidation is not
+    cached after it.
+
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.users = collections.OrderedDict()
+        self.generations = {}
+        self.epoch = 0
+
+    def get(self, tid):
+        with self.lock:
+            values = self.users.get(tid)
+            if values is not None:
+                self.users.move_to_end(tid)
+            return values
+
+    def get_generation(self, tid):
+        """Return the generation to pass to set() for values read from
+        the database after this call.
+
+        """
+        with self.lock:
+            return (self.epoch, self.generations.get(tid, 0))
+
+    def set(self, tid, generation, values):
+        with self.lock:
+            if generation != (self.epoch, self.generations.get(tid, 0)):
+                return
+            self.users[tid] = values
+            self.users.move_to_end(tid)
+            while len(self.users) > self.max_size:
+                self.users.popitem(last=False)
+
+    def invalidate(self, tid):
+        with self.lock:
+            self.users.pop(tid, None)
+            self.generations[tid] = self.generations.get(tid, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.users.clear()
+            self.generations.clear()
+            self.epoch += 1
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Per-command instrumentation: number of SQL statements, time spent in
+the database, wall time and number of outbound messages of every
+handler invocation. Each invocation is logged as a JSON line on the
+cibot.metrics logger and accumulated in histograms, which can be
+exposed in the Prometheus text format by start_metrics_server().
+
+"""
+
+from sqlalchemy import event
+import bisect
+import functools
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger('cibot.metrics')
+slow_logger = logging.getLogger('cibot.slow_queries')
+
+# Upper bounds of the buckets, in seconds for times and in units for
+# counts
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += 1
+        self.sum += value
+
+class CommandStats(object):
+    def __init__(self, command):
+        self.command = command
+        self.statements = 0
+        self.db_time = 0.0
+        self.messages = 0
+        self.wall_time = 0.0
+
+    def as_dict(self):
+        return {'command': self.command,
+                'statements': self.statements,
+                'db_time': round(self.db_time, 6),
+                'wall_time': round(self.wall_time, 6),
+                'messages': self.messages}
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.histograms = {}
+        self.slow_query_threshold = 0.1
+
+    def current(self):
+        return getattr(self.local, 'stats', None)
+
+    def record_query(self, duration, statement, parameters):
+        stats = self.current()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += duration
+        if duration >= self.slow_query_threshold:
+            slow_logger.warning("Slow query (%.1f ms) in %s: %s; parameters: %r",
+                                duration * 1000.0, stats.command if stats is not None else None,
+                                statement, parameters)
+
+    def record_message(self):
+        stats = self.current()
+        if stats is not None:
+            stats.messages += 1
+
+    def _observe(self, stats):
+        values = [('statements', COUNT_BUCKETS, stats.statements),
+                  ('db_seconds', TIME_BUCKETS, stats.db_time),
+                  ('wall_seconds', TIME_BUCKETS, stats.wall_time),
+                  ('messages', COUNT_BUCKETS, stats.messages)]
+        with self.lock:
+            for metric, buckets, value in values:
+                key = (metric, stats.command)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+
+    def instrument(self, command, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            stats = CommandStats(command)
+            previous = self.current()
+            self.local.stats = stats
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.wall_time = time.perf_counter() - start
+                self.local.stats = previous
+                self._observe(stats)
+                logger.info(json.dumps(stats.as_dict()))
+        return wrapped
+
+    def render(self):
+        """Return the histograms in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            for (metric, command), histogram in sorted(self.histograms.items()):
+                name = 'cibot_command_' + metric
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{command="{}",le="{}"}} {}'.format(name, command, bound, cumulative))
+                lines.append('{}_sum{{command="{}"}} {}'.format(name, command, histogram.sum))
+                lines.append('{}_count{{command="{}"}} {}'.format(name, command, histogram.total))
+        return '\n'.join(lines) + '\n'
+
+    def install(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            duration = time.perf_counter() - conn.info['query_start'].pop()
+            self.record_query(duration, statement, parameters)
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            if context.connection is not None and context.connection.info.get('query_start'):
+                context.connection.info['query_start'].pop()
+
+metrics = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def start_metrics_server(listen='127.0.0.1', port=9090):
+    server = MetricsServer((listen, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from data import Lease
+
+logger = logging.getLogger(__name__)
+
+class LeaderLease(object):
+    """Leader election through a Lease row: the holder renews it once a
+    third of its duration has passed, the others take it over once it
+    expires. Until it is enabled the process is always the leader.
+
+    """
+    def __init__(self, name='jobs', duration=90.0):
+        self.name = name
+        self.duration = duration
+        self.holder = None
+        self.lock = threading.Lock()
+        self.renewed = None
+        self.leader = False
+
+    def enable(self, holder, duration=None):
+        self.holder = holder
+        if duration is not None:
+            self.duration = duration
+
+    def is_leader(self):
+        if self.holder is None:
+            return True
+        with self.lock:
+            now = time.time()
+            if self.renewed is None or now >= self.renewed + self.duration / 3.0:
+                # The lease is counted from before the query, so that it
+                # never looks longer here than in the database
+                leader = Lease.acquire(self.name, self.holder, self.duration)
+                if leader != self.leader:
+                    logger.info("%s is %s the leader", self.holder, "now" if leader else "no longer")
+                self.leader = leader
+                self.renewed = now
+            return self.leader
+
+leader = LeaderLease()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Bring an existing database up to the current schema.
+
+create_all() only creates the missing tables, so the columns and
+indexes added to existing tables are applied here, in order, and the
+last applied migration is recorded in the schema_version table. Every
+migration checks what is already there, so that on a database just
+created by create_all() they do nothing. Indexes are built without
+blocking writes where the database supports it, and data is backfilled
+in batches, each in its own transaction.
+
+"""
+
+from sqlalchemy import MetaData, Table, Column, Integer, DateTime, select, inspect, exists, bindparam
+
+import datetime
+import logging
+
+from config import get_config
+from data import get_engine, create_db, SessionGen, Phase, PhaseTally, User, Statement
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata,
+                       Column('version', Integer, primary_key=True),
+                       Column('applied', DateTime, nullable=False))
+
+def has_column(engine, table_name, column_name):
+    return column_name in [column['name'] for column in inspect(engine).get_columns(table_name)]
+
+def has_index(engine, table_name, index_name):
+    return index_name in [index['name'] for index in inspect(engine).get_indexes(table_name)]
+
+def add_column(engine, column, batch_size):
+    """Add column to its (existing) table. The column is added as
+    nullable with its server default, which on SQLite and PostgreSQL
+    11 or later only changes the catalog; the rows that are still
+    NULL are then backfilled in batches, and finally the column is
+    made NOT NULL where the database can do it in place.
+
+    """
+    table = column.table
+    if has_column(engine, table.name, column.name):
+        return
+    preparer = engine.dialect.identifier_preparer
+    ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(preparer.format_table(table), preparer.format_column(column),
+                                                   column.type.compile(dialect=engine.dialect))
+    if column.server_default is not None:
+        ddl += ' DEFAULT {}'.format(column.server_default.arg.text)
+    with engine.begin() as conn:
+        conn.execute(ddl)
+    if column.server_default is not None:
+        backfill(table, table.c[column.name] == None, {column.name: column.server_default.arg}, batch_size)
+    if not column.nullable and engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            conn.execute('ALTER TABLE {} ALTER COLUMN {} SET NOT NULL'.format(
+                preparer.format_table(table), preparer.format_column(column)))
+
+def create_index(engine, index):
+    """Create index, if missing. On PostgreSQL the index is built
+    concurrently, which does not block writes but cannot run in a
+    transaction; elsewhere (SQLite in particular) the table is locked
+    while the index is built.
+
+    """
+    table = index.table
+    if has_index(engine, table.name, index.name):
+        return
+    preparer = engine.dialect.identifier_preparer
+    concurrently = 'CONCURRENTLY ' if engine.dialect.name == 'postgresql' else ''
+    ddl = 'CREATE INDEX {}{} ON {} ({})'.format(concurrently, preparer.format_index(index),
+                                                preparer.format_table(table),
+                                                ', '.join([preparer.format_column(column) for column in index.columns]))
+    with engine.connect() as conn:
+        if concurrently:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            conn.execute(ddl)
+        else:
+            with conn.begin():
+                conn.execute(ddl)
+
+def backfill(table, condition, values, batch_size):
+    """Update the rows of table matching condition with values, at most
+    batch_size of them per transaction, walking the primary key.
+    Return the number of updated rows.
+
+    """
+    key = list(table.primary_key.columns)[0]
+    last, total = None, 0
+    while True:
+        with SessionGen(True) as session:
+            query = select([key]).where(condition).order_by(key).limit(batch_size)
+            if last is not None:
+                query = query.where(key > last)
+            ids = [row[0] for row in session.execute(query)]
+            if len(ids) == 0:
+                return total
+            session.execute(table.update().where(key.in_(ids)).values(**values))
+        last = ids[-1]
+        total += len(ids)
+        logger.info("Backfilled %d rows of %s", total, table.name)
+
+def backfill_phase_tallies(engine, batch_size):
+    """Build the tallies of the phases created before them, which would
+    otherwise only be built when a statement changes.
+
+    """
+    last, total = 0, 0
+    while True:
+        with SessionGen(True) as session:
+            ids = [phase_id for (phase_id,) in session.query(Phase.id).filter(Phase.id > last). \
+                   filter(~exists().where(PhaseTally.phase_id == Phase.id)).order_by(Phase.id).limit(batch_size)]
+            if len(ids) == 0:
+                break
+            missing = PhaseTally.expected(session).filter(Phase.id.in_(ids))
+            session.execute(PhaseTally.__table__.insert().from_select(
+                ['phase_id', 'circle_id', 'presents', 'absents', 'known_total', 'no_answers'], missing.statement))
+        last = ids[-1]
+        total += len(ids)
+        logger.info("Built %d phase tallies", total)
+
+def count_no_answers(engine, batch_size):
+    """Fill phase_tallies.no_answers, which is zero in the tallies
+    created before it.
+
+    """
+    table = PhaseTally.__table__
+    last, total = 0, 0
+    while True:
+        with SessionGen(True) as session:
+            ids = [phase_id for (phase_id,) in session.query(PhaseTally.phase_id).filter(PhaseTally.phase_id > last). \
+                   order_by(PhaseTally.phase_id).limit(batch_size)]
+            if len(ids) == 0:
+                break
+            rows = PhaseTally.expected(session).filter(Phase.id.in_(ids)).all()
+            session.execute(table.update().where(table.c.phase_id == bindparam('tally_id')). \
+                values(no_answers=bindparam('count')), [{'tally_id': row[0], 'count': row[-1]} for row in rows])
+        last = ids[-1]
+        total += len(ids)
+        logger.info("Counted the missing answers of %d phase tallies", total)
+
+def index_migration(table, name):
+    return lambda engine, batch_size: create_index(engine, [index for index in table.indexes if index.name == name][0])
+
+# Append only: the position of a migration in this list is its version
+MIGRATIONS = [
+    ("Add users.digest", lambda engine, batch_size: add_column(engine, User.__table__.c.digest, batch_size)),
+    ("Index users.circle_id", index_migration(User.__table__, 'ix_users_circle_id')),
+    ("Index statements.phase_id", index_migration(Statement.__table__, 'ix_statements_phase_id')),
+    ("Index phase_tallies.circle_id", index_migration(PhaseTally.__table__, 'ix_phase_tallies_circle_id')),
+    ("Build the missing phase tallies", backfill_phase_tallies),
+    ("Add phase_tallies.no_answers", lambda engine, batch_size: add_column(engine, PhaseTally.__table__.c.no_answers, batch_size)),
+    ("Count the missing answers in the tallies", count_no_answers),
+    ]
+
+def get_version(engine):
+    with engine.connect() as conn:
+        version = conn.execute(select([schema_version.c.version]).order_by(schema_version.c.version.desc()).limit(1)).scalar()
+    return version if version is not None else 0
+
+def upgrade(batch_size=None):
+    """Create the missing tables and apply the pending migrations.
+    Return the number of applied migrations.
+
+    """
+    if batch_size is None:
+        batch_size = get_config('migration_batch_size', 1000, int)
+    engine = get_engine()
+    create_db()
+    metadata.create_all(engine)
+    version = get_version(engine)
+    for number, (description, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Applying migration %d: %s", number, description)
+        migration(engine, batch_size)
+        with engine.begin() as conn:
+            conn.execute(schema_version.insert().values(version=number, applied=datetime.datetime.now()))
+    return len(MIGRATIONS) - version
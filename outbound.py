@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+from telegram.error import TelegramError, NetworkError, RetryAfter, BadRequest, TimedOut
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+class Outbox(object):
+    """Queue of outbound messages, delivered by a pool of worker
+    threads.
+
+    Telegram allows roughly 30 messages per second overall, one
+    message per second to the same private chat and 20 messages per
+    minute to the same group; messages are spaced accordingly. Messages
+    to the same chat are delivered in order. On a 429 the chat is
+    paused for the time requested by Telegram, while network errors are
+    retried with an exponential backoff. Requests rejected by Telegram
+    (which in python-telegram-bot are network errors too) are dropped,
+    and so are the ones that timed out: Telegram may have delivered
+    them anyway, and a message lost is better than a message repeated.
+
+    As long as the outbox is not started, messages are sent
+    synchronously.
+
+    """
+    def __init__(self, global_rate=30.0, chat_interval=1.0, group_interval=3.0, max_retries=5, backoff=1.0):
+        self.global_interval = 1.0 / global_rate
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.bot = None
+        self.running = False
+        self.threads = []
+        self.cond = threading.Condition()
+        self.chats = {}
+        self.ready = []
+        self.busy = set()
+        self.cooldown = {}
+        self.next_global = 0.0
+        self.counter = itertools.count()
+
+    def start(self, bot, workers=4):
+        with self.cond:
+            self.bot = bot
+            self.running = True
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name='outbox_{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=10.0):
+        """Wait for the queued messages to be delivered (at most timeout
+        seconds) and stop the workers.
+
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while (len(self.chats) > 0 or len(self.busy) > 0) and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def send_message(self, bot, **kwargs):
+        metrics.record_message()
+        if not self.running:
+            bot.send_message(**kwargs)
+            return
+        chat_id = kwargs['chat_id']
+        with self.cond:
+            if chat_id not in self.chats:
+                self.chats[chat_id] = collections.deque()
+                self._push(chat_id, self.cooldown.pop(chat_id, 0.0))
+            self.chats[chat_id].append([kwargs, 0])
+            self.cond.notify()
+
+    def pending(self):
+        with self.cond:
+            return sum([len(queue) for queue in self.chats.values()])
+
+    def _push(self, chat_id, not_before):
+        heapq.heappush(self.ready, (not_before, next(self.counter), chat_id))
+
+    def _cool_down(self, chat_id, not_before):
+        # Remember when the chat can be written again, so that a message
+        # enqueued right after the queue drained is still spaced
+        self.cooldown[chat_id] = not_before
+        if len(self.cooldown) > 1024:
+            now = time.time()
+            for key in [key for key, value in self.cooldown.items() if value <= now]:
+                del self.cooldown[key]
+
+    def _interval(self, chat_id):
+        # Negative ids are groups
+        return self.group_interval if chat_id < 0 else self.chat_interval
+
+    def _take(self):
+        # Called with the lock held; returns the chat_id whose next
+        # message can be sent, or None when stopping
+        while self.running:
+            now = time.time()
+            if len(self.ready) > 0:
+                wait = max(self.ready[0][0], self.next_global) - now
+                if wait <= 0:
+                    _, _, chat_id = heapq.heappop(self.ready)
+                    self.busy.add(chat_id)
+                    self.next_global = max(now, self.next_global) + self.global_interval
+                    return chat_id
+                self.cond.wait(wait)
+            else:
+                self.cond.wait()
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                chat_id = self._take()
+                if chat_id is None:
+                    return
+                item = self.chats[chat_id][0]
+            not_before = self._deliver(chat_id, item)
+            with self.cond:
+                self.busy.discard(chat_id)
+                queue = self.chats[chat_id]
+                if not_before is None:
+                    queue.popleft()
+                    not_before = time.time() + self._interval(chat_id)
+                if len(queue) > 0:
+                    self._push(chat_id, not_before)
+                else:
+                    del self.chats[chat_id]
+                    self._cool_down(chat_id, not_before)
+                self.cond.notify_all()
+
+    def _deliver(self, chat_id, item):
+        """Try to send a message; return None if it must be dropped from
+        the queue, or the time when it should be retried.
+
+        """
+        kwargs, attempts = item
+        try:
+            self.bot.send_message(**kwargs)
+        except RetryAfter as e:
+            logger.info("Flood control on chat %s, retrying in %s seconds", chat_id, e.retry_after)
+            return time.time() + e.retry_after
+        except BadRequest as e:
+            logger.error("Telegram rejected the message to chat %s: %s", chat_id, e)
+        except TimedOut as e:
+            logger.warning("Message to chat %s timed out, it may not have been delivered: %s", chat_id, e)
+        except NetworkError as e:
+            item[1] = attempts + 1
+            if item[1] > self.max_retries:
+                logger.error("Dropping message to chat %s after %d attempts: %s", chat_id, attempts + 1, e)
+                return None
+            return time.time() + self.backoff * 2 ** attempts
+        except TelegramError as e:
+            logger.error("Cannot send message to chat %s: %s", chat_id, e)
+        except Exception:
+            logger.exception("Cannot send message to chat %s", chat_id)
+        return None
+
+outbox = Outbox()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import heapq
+import threading
+
+from data import Moment
+
+class ReminderScheduler(object):
+    """Single heap of the next reminder time of every moment.
+
+    Each refresh reloads the reminder times of all the moments, which
+    is a single query on a small table, and reschedules the ones that
+    differ, so that moments added, moved or removed while the bot is
+    running are picked up without a restart, whoever wrote them.
+
+    Every process follows the schedule, but only the leader sends:
+    the others defer the reminders falling due, so that if they take
+    over from a leader that failed they can still send them.
+
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.scheduled = {}
+        self.reminder_times = {}
+        self.deferred = {}
+
+    def _schedule(self, moment_id, reminder_time, now):
+        if reminder_time is None:
+            self.scheduled.pop(moment_id, None)
+            return
+        when = datetime.datetime.combine(now.date(), reminder_time)
+        if when <= now:
+            when += datetime.timedelta(days=1)
+        self.scheduled[moment_id] = when
+        heapq.heappush(self.heap, (when, moment_id))
+
+    def refresh(self, session, now=None):
+        """Reschedule the moments whose reminder time changed; return
+        how many they are.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        reminder_times = dict(session.query(Moment.id, Moment.reminder_time).all())
+        with self.lock:
+            changed = [moment_id for moment_id in set(self.reminder_times) | set(reminder_times)
+                       if moment_id not in self.reminder_times or moment_id not in reminder_times
+                       or self.reminder_times[moment_id] != reminder_times[moment_id]]
+            for moment_id in changed:
+                # Heap entries of removed moments are skipped, as they
+                # are not in scheduled any more
+                self.scheduled.pop(moment_id, None)
+                if moment_id in reminder_times:
+                    self._schedule(moment_id, reminder_times[moment_id], now)
+            self.reminder_times = reminder_times
+            return len(changed)
+
+    def pop_due(self, now=None):
+        """Return the ids of the moments whose reminder is due and
+        schedule them again for the following day.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        due = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                when, moment_id = heapq.heappop(self.heap)
+                # Skip entries superseded by a refresh
+                if self.scheduled.get(moment_id) != when:
+                    continue
+                due.append(moment_id)
+                when += datetime.timedelta(days=1)
+                self.scheduled[moment_id] = when
+                heapq.heappush(self.heap, (when, moment_id))
+        return due
+
+    def defer(self, moment_ids, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        with self.lock:
+            for moment_id in moment_ids:
+                self.deferred[moment_id] = now
+
+    def pop_deferred(self, since):
+        """Return the ids of the moments deferred since the given time
+        and forget all the deferred ones.
+
+        """
+        with self.lock:
+            deferred = [moment_id for moment_id, when in self.deferred.items() if when >= since]
+            self.deferred = {}
+        return deferred
+
+    def next_time(self):
+        with self.lock:
+            while len(self.heap) > 0 and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if len(self.heap) > 0 else None
+
+scheduler = ReminderScheduler()
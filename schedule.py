@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import collections
+import datetime
+import threading
+
+class ScheduleIndex(object):
+    """Sorted moment times of a circle, used to find the current or
+    the next moment with a binary search.
+
+    """
+    def __init__(self, moments):
+        # moments is an iterable of (time, moment_id) pairs
+        self.moments = sorted(moments)
+        self.times = [moment[0] for moment in self.moments]
+
+    def resolve(self, when, successive=False):
+        """Return the (moment_id, date) pair of the phase that is
+        current at when (or the one after that if successive is
+        true).
+
+        """
+        date = when.date()
+        idx = bisect.bisect_right(self.times, when.time())
+        if successive:
+            if idx == len(self.moments):
+                idx = 0
+                date += datetime.timedelta(days=1)
+        else:
+            idx -= 1
+            if idx < 0:
+                idx = len(self.moments) - 1
+                date -= datetime.timedelta(days=1)
+        return self.moments[idx][1], date
+
+class ScheduleCache(object):
+    """Process wide cache of the schedule indices of the circles and
+    of the ids of the phases, keyed by (moment_id, date).
+
+    """
+    def __init__(self, max_phases=4096):
+        self.max_phases = max_phases
+        self.lock = threading.Lock()
+        self.indices = {}
+        self.phases = collections.OrderedDict()
+        self.today = None
+        # Moments as last seen by sync(), by id
+        self.snapshot = None
+
+    def get_index(self, circle_id):
+        with self.lock:
+            return self.indices.get(circle_id)
+
+    def set_index(self, circle_id, moments):
+        index = ScheduleIndex(moments)
+        with self.lock:
+            self.indices[circle_id] = index
+        return index
+
+    def _rollover(self):
+        # Forget phases that can no longer be current; yesterday is
+        # kept, because its last moment lasts until today's first one
+        today = datetime.date.today()
+        if self.today == today:
+            return
+        self.today = today
+        horizon = today - datetime.timedelta(days=1)
+        for key in [key for key in self.phases if key[1] < horizon]:
+            del self.phases[key]
+
+    def get_phase_id(self, moment_id, date):
+        with self.lock:
+            self._rollover()
+            phase_id = self.phases.get((moment_id, date))
+            if phase_id is not None:
+                self.phases.move_to_end((moment_id, date))
+            return phase_id
+
+    def set_phase_id(self, moment_id, date, phase_id):
+        with self.lock:
+            self._rollover()
+            self.phases[(moment_id, date)] = phase_id
+            self.phases.move_to_end((moment_id, date))
+            while len(self.phases) > self.max_phases:
+                self.phases.popitem(last=False)
+
+    def invalidate_moment(self, circle_id, moment_id):
+        with self.lock:
+            self._invalidate(circle_id, moment_id)
+
+    def _invalidate(self, circle_id, moment_id):
+        self.indices.pop(circle_id, None)
+        for key in [key for key in self.phases if key[0] == moment_id]:
+            del self.phases[key]
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.indices.clear()
+        self.phases.clear()
+
+    def sync(self, moments):
+        """Compare moments, the (moment_id, circle_id, time,
+        reminder_time) rows of all the moments, with the ones passed to
+        the previous call and invalidate what changed, so that moments
+        written by other processes or directly in the database are
+        noticed. Return the number of changed moments.
+
+        """
+        snapshot = dict([(row[0], tuple(row[1:])) for row in moments])
+        with self.lock:
+            previous = self.snapshot
+            self.snapshot = snapshot
+            if previous is None:
+                # Anything cached before the first snapshot may be stale
+                self._clear()
+                return len(snapshot)
+            changed = [moment_id for moment_id in set(previous) | set(snapshot)
+                       if previous.get(moment_id) != snapshot.get(moment_id)]
+            for moment_id in changed:
+                # The moment may also have moved to another circle
+                for row in [previous.get(moment_id), snapshot.get(moment_id)]:
+                    if row is not None:
+                        self._invalidate(row[0], moment_id)
+            return len(changed)
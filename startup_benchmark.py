@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the startup of the bot on a database with many
+circles: cibot.py is started against the fake Telegram API of
+fake_api.py, with an update already waiting, and the time until it
+starts polling and until it answers is reported.
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from benchmark import populate, prepare, scratch_dir
+from fake_api import FakeBotAPI, make_update
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of the bot")
+    parser.add_argument('--circles', type=int, default=5000)
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--moments', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    api = FakeBotAPI()
+    api.start()
+    try:
+        with scratch_dir('cibot_startup_') as workdir:
+            return measure(args, api, workdir)
+    finally:
+        api.stop()
+
+def measure(args, api, workdir):
+    data, cibot = prepare(workdir, None, {'telegram_token': '123:fake', 'bot_api_url': api.url,
+                                          'update_mode': 'polling'})
+    # The bot reads the database from the configuration file
+    with open('database_url', 'w') as fout:
+        fout.write(str(data.get_engine().url))
+    start = time.time()
+    data.create_db()
+    populate(data, args.circles, args.members, args.moments, 0.0)
+    print("Populated {} circles in {:.1f} s".format(args.circles, time.time() - start))
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cibot.py')
+    results = []
+    for run in range(args.runs):
+        api.first_poll = None
+        del api.sent[:]
+        del api.sent_times[:]
+        del api.updates[:]
+        api.add_update(make_update(run + 1, 1, '/status'))
+        start = time.time()
+        bot = subprocess.Popen([sys.executable, script], stderr=subprocess.DEVNULL)
+        try:
+            api.wait_for_messages(1, timeout=120.0)
+        finally:
+            bot.terminate()
+            bot.wait()
+        if api.first_poll is None or len(api.sent_times) == 0:
+            print("Run {}: the bot did not answer".format(run + 1))
+            return 1
+        results.append((api.first_poll - start, api.sent_times[0] - start))
+        print("Run {}: polling after {:.2f} s, first answer after {:.2f} s".format(run + 1, *results[-1]))
+    print("Best: polling after {:.2f} s, first answer after {:.2f} s".format(
+        min([poll for poll, answer in results]), min([answer for poll, answer in results])))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+class StatusCache(object):
+    """Cache of the rendered /status of each (circle, phase), tagged
+    with a per-circle version number that is bumped whenever a
+    statement or the membership of the circle changes.
+
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.entries = collections.OrderedDict()
+
+    def get_version(self, circle_id):
+        with self.lock:
+            return self.versions.get(circle_id, 0)
+
+    def bump(self, circle_id):
+        with self.lock:
+            self.versions[circle_id] = self.versions.get(circle_id, 0) + 1
+
+    def get(self, key, version):
+        """Return the value cached for key, if it was computed at the
+        given version.
+
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, value):
+        with self.lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Stress test of the keyed dispatch: random /present and /absent
+updates are run concurrently on a KeyedExecutor, keyed as the bot does
+(or not keyed at all with --unkeyed, which is expected to fail),
+against a scratch SQLite database. Then the stored choice of every user
+must be the one of their last update and the tallies must match the
+statements.
+
+"""
+
+import argparse
+import random
+import sys
+
+from benchmark import FakeBot, make_update, populate, prepare, scratch_dir
+
+def main():
+    parser = argparse.ArgumentParser(description="Fire concurrent /present and /absent updates")
+    parser.add_argument('--circles', type=int, default=10)
+    parser.add_argument('--members', type=int, default=10)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--unkeyed', action='store_true', help="do not serialize the updates of a circle")
+    parser.add_argument('--database', help="SQLite file to use instead of a temporary one")
+    args = parser.parse_args()
+    with scratch_dir('cibot_stress_') as workdir:
+        return run(args, workdir)
+
+def run(args, workdir):
+    data, cibot = prepare(workdir, args.database, {'db_pool_size': args.workers + 1})
+    from dispatch import KeyedExecutor
+    data.create_db()
+    populate(data, args.circles, args.members, 1, 0.0)
+    # Phases are created by the handlers themselves
+    with data.SessionGen(True) as session:
+        session.query(data.PhaseTally).delete()
+        session.query(data.Phase).delete()
+
+    bot = FakeBot()
+    rng = random.Random(0)
+    tids = list(range(1, args.circles * args.members + 1))
+    expected = {}
+    executor = KeyedExecutor(args.workers)
+    executor.start()
+    for i in range(args.updates):
+        tid = rng.choice(tids)
+        choice = rng.choice([1, 0])
+        handler = cibot.handle_present if choice == 1 else cibot.handle_absent
+        update = make_update(tid, '/present' if choice == 1 else '/absent')
+        key = None if args.unkeyed else cibot.get_dispatch_key(update)
+        executor.submit(key, handler, bot, update)
+        expected[tid] = choice
+    executor.stop()
+
+    failures = 0
+    with data.SessionGen(False) as session:
+        now = data.datetime.datetime.now()
+        for tid, choice in sorted(expected.items()):
+            user = session.query(data.User).filter(data.User.tid == tid).one()
+            statement = user.get_current_statement(when=now)
+            actual = statement.choice if statement is not None else None
+            if actual != choice:
+                failures += 1
+                print("User {}: expected {}, stored {}".format(tid, choice, actual))
+        drifts = data.check_tallies(session)
+    for phase_id, stored, computed in drifts:
+        print("Phase {}: tally {}, expected {}".format(phase_id, stored, computed))
+
+    print("{} updates, {} users, {} lost, {} tally drifts".format(args.updates, len(expected), failures, len(drifts)))
+    return 1 if failures > 0 or len(drifts) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from telegram import Update
+import http.server
+import json
+import logging
+import socketserver
+import threading
+
+logger = logging.getLogger(__name__)
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, Telegram reuses them for the next updates
+    protocol_version = 'HTTP/1.1'
+
+    def reject(self, code):
+        # The body is not read, so what follows on the connection is
+        # not the next request: close it
+        self.close_connection = True
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.reject(403)
+            return
+        try:
+            length = int(self.headers.get('content-length'))
+        except (TypeError, ValueError):
+            self.reject(411)
+            return
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        try:
+            update = Update.de_json(json.loads(body.decode('utf-8')), self.server.bot)
+        except Exception:
+            logger.exception("Cannot decode update")
+            return
+        self.server.update_queue.put(update)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+class WebhookServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server that receives updates from Telegram and puts them
+    in the update queue of the dispatcher. Each connection is served by
+    its own thread.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, update_queue, url_path, bot):
+        http.server.HTTPServer.__init__(self, address, WebhookHandler)
+        self.update_queue = update_queue
+        self.url_path = url_path
+        self.bot = bot
+
+def start_webhook(updater, listen='127.0.0.1', port=8443, url_path='', webhook_url=None):
+    """Start the dispatcher and the job queue of updater and feed them
+    with the updates received on http://listen:port/url_path. If
+    webhook_url is given, it is registered with Telegram, otherwise TLS
+    termination and registration are expected to happen elsewhere.
+
+    """
+    if not url_path.startswith('/'):
+        url_path = '/' + url_path
+    server = WebhookServer((listen, port), updater.update_queue, url_path, updater.bot)
+    if webhook_url is not None:
+        updater.bot.setWebhook(webhook_url=webhook_url)
+
+    # Updater.start_webhook() would use the server of python-telegram-bot,
+    # which serves a connection at a time and closes it after each update;
+    # these are the attributes it sets, so that Updater.stop() shuts
+    # everything down as in polling mode
+    updater.running = True
+    updater.httpd = server
+    updater.job_queue.start()
+    for target, name in [(updater.dispatcher.start, 'dispatcher'), (server.serve_forever, 'webhook')]:
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+    logger.info("Listening for updates on %s:%d%s", listen, server.server_address[1], url_path)
+    return server